@@ -1,9 +1,13 @@
-import json
+import asyncio
 import os
+import queue
 import time
 import re
+import threading
 import traceback
+from collections import deque
 from pathlib import Path
+from typing import Iterator
 
 from textual.app import App, ComposeResult
 from textual.widgets import Header, Footer, Input, Static, RichLog
@@ -13,11 +17,135 @@ from textual.binding import Binding
 # Relative imports from the new structure
 from .config import (
     ConfigManager, PermissionsManager, 
-    HISTORY_FILE, ERROR_LOG_FILE, CONFIG_FILE, TEMP_PROJECT_DIR
+    HISTORY_FILE, ERROR_LOG_FILE, CONFIG_FILE, TEMP_PROJECT_DIR,
+    atomic_write_bytes, json_loads, json_dumps
 )
 from .model_manager import ModelManager
 from .tool_executor import ToolExecutor
 
+# --- Precompiled patterns for tool-call parsing and response cleanup ---
+# Compiled once at import so the agent loop never re-parses them (or loses them to re's bounded cache)
+_TOOL_CALL_RE=re.compile(r'<tool_call\s+.*?\s*/>', re.DOTALL)
+_FUNC_RE=re.compile(r'function=["\'](write_file|run_code)["\']')
+_PATH_RE=re.compile(r'path=["\'](?P<path>[^"\']+)["\']')
+_CONTENT_RE=re.compile(r'content=(?P<quote>["\'])(?P<content>.*?)(?P=quote)\s*/>', re.DOTALL)
+_CMD_RE=re.compile(r'command=(?P<quote>["\'])(?P<command>.*?)(?P=quote)\s*/>', re.DOTALL)
+_THINK_RE=re.compile(r'<think>.*?</think>', re.DOTALL)
+# Whole-tag patterns for the usual attribute order (function first, as the system prompt asks).
+# One anchored match per tag replaces the function/path/content searches above; other orders fall back to those.
+_WRITE_FILE_RE=re.compile(
+    r'<tool_call\s+function=["\'](?P<function>write_file)["\'][^>]*?path=["\'](?P<path>[^"\']+)["\']'
+    r'[^>]*?content=(?P<quote>["\'])(?P<content>.*?)(?P=quote)\s*/>',
+    re.DOTALL
+)
+_RUN_CODE_RE=re.compile(
+    r'<tool_call\s+function=["\'](?P<function>run_code)["\'][^>]*?command=(?P<quote>["\'])(?P<command>.*?)(?P=quote)\s*/>',
+    re.DOTALL
+)
+
+# Escapes the agent is told to use (plus common HTML entities), reversed in a single pass.
+# Alternation is tried left to right at each position, so an escaped backslash (\\) is consumed
+# before it could be mistaken for the start of \n, \t or \r.
+_UNESCAPE_RE=re.compile(r'&quot;|&amp;|\\\\|\\n|\\t|\\r')
+_UNESCAPE_MAP={
+    '&quot;': '"',
+    '&amp;': '&',
+    '\\\\': '\\',
+    '\\n': '\n',
+    '\\t': '\t',
+    '\\r': '\r',
+}
+
+
+def _strip_think(text: str) -> str:
+    """Removes <think>...</think> blocks and surrounding whitespace; the regex only runs if a tag is present."""
+    if "<think>" in text:
+        text=_THINK_RE.sub('', text)
+    return text.strip()
+
+
+# Slash commands understood by action_process_command (also drives autocompletion)
+_COMMANDS=("/chat", "/agent", "/model")
+_COMMAND_SET=frozenset(_COMMANDS)
+# Arguments to /model that clear the temporary override
+_RESET_TOKENS=frozenset(("reset", "clear", "default"))
+
+
+def _unescape_safe(s: str) -> str:
+    """
+    Replaces literal \n, \t, \r, \\ with actual characters,
+    AND reverses common HTML entities used for quote/ampersand.
+    """
+    return _UNESCAPE_RE.sub(lambda m: _UNESCAPE_MAP[m.group(0)], s)
+
+
+# System prompt for agent mode. It never varies, so it is built once at import.
+_AGENT_SYSTEM_PROMPT=(
+    "You are an expert CLI agent. Your goal is to satisfy the user's request using tools. "
+    "You MUST strictly adhere to the following rules:\n\n"
+    "1. **TOOL USAGE (CRITICAL):** Output ONLY ONE single, self-closing XML tag per turn. "
+    "   It MUST be in the form: <tool_call function=\"TOOL_NAME\" ARG1=\"value\" ARG2=\"value\"/>. "
+    "   **NEVER** use separate opening and closing tags (e.g., `<tool_call>...</tool_call>`).\n"
+    "2. **ESCAPING (CRITICAL):** Arguments MUST use double quotes. For `write_file` content, "
+    "   use **literal backslash sequences**:\n"
+    "   - **Newline (`\\n`)** MUST be `\\\\n`.\n"
+    "   - **Tab (`\\t`)** MUST be `\\\\t`.\n"
+    "3. **AVAILABLE TOOLS:**\n"
+    "   - [bold]write_file[/bold](path, content): Writes Python/script code. Content **must** be escaped and provided as a single attribute value.\n"
+    "   - [bold]run_code[/bold](command): Executes shell commands (e.g., `python file.py`).\n"
+    
+    # --- CRITICALLY UPDATED CODE OUTPUT MANDATE ---
+    "4. **CODE OUTPUT MANDATE (CRITICAL):** All code that returns a value intended for the user MUST be wrapped in an explicit `print()` call to ensure the output is written to STDOUT (e.g., `print(function_name())`). If the code doesn't output to STDOUT, the agent fails.\n"
+    
+    "5. **DEBUG MANDATE (CRITICAL):** Treat any `TOOL:ERROR`, `PARSER:ERROR`, or **EMPTY/WHITESPACE-ONLY** output from `run_code` as a failure. Your immediate next step **MUST** be to rewrite the file to correct the logic (e.g., adding the missing `print()`). **DO NOT** attempt to justify or declare success when the output is empty.\n"
+    "6. **AUTONOMY:** Do not ask for human permission. Persist until the mission is validated and fully completed. Stop only with a final, non-tool answer."
+)
+
+# The same dict object opens every agent conversation, so the prompt prefix sent to Ollama is
+# byte-identical across requests and its KV cache can reuse the prefix. Never mutated.
+_AGENT_SYSTEM_MESSAGE={"role": "system", "content": _AGENT_SYSTEM_PROMPT}
+
+# Static lines of the startup banner written by on_mount
+_WELCOME_BANNER="[WELCOME] Own-CLI Agent V2.0 - Local LLM Agentic CLI\nMade by jnetai.com forum jnet.forumotion.com"
+_READY_MESSAGE="[STATUS] Ready. Use /agent /chat /model before your message."
+
+# Fixed lines around the permission-dependent entries printed by action_show_tools
+_TOOLS_INFO_TEMPLATE="\n".join((
+    "[AVAILABLE TOOLS]",
+    "  [bold]run_code[/bold]: Executes shell commands. Requires 'allow_code_execution': {allow_code_execution}",
+    "  [bold]write_file[/bold]: Writes content to the project folder. Requires 'allow_file_io': {allow_file_io}",
+    "[STATUS] Use /agent to enable tool calling mode."
+))
+
+# Seconds the autocompletion model list is reused before a background refresh is scheduled
+_MODEL_SUGGESTIONS_TTL=30
+
+# error.log entries are written by a background thread in batches of up to this many entries,
+# or whatever has queued up once this many seconds have passed since the first one
+_ERROR_LOG_BATCH=10
+_ERROR_LOG_LINGER=0.2
+
+
+class _ThreadSafeLog:
+    """
+    Stands in for the RichLog when handed to the managers. Writes made from a worker thread
+    are marshalled onto the app thread with call_from_thread; writes on the app thread go straight through.
+    """
+
+    def __init__(self, app: App, log: RichLog):
+        self._app=app
+        self._log=log
+        self._app_thread_id=threading.get_ident()
+
+    def in_app_thread(self) -> bool:
+        return threading.get_ident() == self._app_thread_id
+
+    def write(self, content):
+        if self.in_app_thread():
+            self._log.write(content)
+        else:
+            self._app.call_from_thread(self._log.write, content)
+
 
 class OwnCLIApp(App):
     """The main Textual application for the CLI agent."""
@@ -84,6 +212,8 @@ class OwnCLIApp(App):
     ]
 
     MAX_AGENT_STEPS=3000
+    MAX_HISTORY_ENTRIES=50 # Unique commands kept in memory and on disk
+    MAX_CHAT_CONTEXT=5 # Chat messages sent to the model in chat mode (and the most kept in memory)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -93,111 +223,311 @@ class OwnCLIApp(App):
         self.sub_title="Enter a goal or a message. Use /agent  /chat  /model"
         self.log_display=RichLog(id="log-display", highlight=True, markup=True)
         
-        self.command_history=self._load_history()
+        # Filled in by _prewarm_history once the app is mounted, so startup never waits on disk.
+        # The list object is kept stable because the Input widget holds a reference to it.
+        self.command_history: list[str]=[]
+        self._history_set: set[str]=set() # O(1) membership sidecar for command_history
+        self._history_loaded=False
         
         # Pass self (the App instance) to managers for error logging access
-        self.model_manager=ModelManager(self.config, self.log_display, self)
-        self.tool_executor=ToolExecutor(self.permissions, self.log_display, self)
-        self.chat_history=[]
+        # Model calls and tools run in worker threads (see _refresh_ollama_models and the query handlers),
+        # so the managers get a log wrapper that hops back to the app thread
+        self._safe_log=_ThreadSafeLog(self, self.log_display)
+        self.model_manager=ModelManager(self.config, self._safe_log, self)
+        self.tool_executor=ToolExecutor(self.permissions, self._safe_log, self)
+        # Bounded: older turns are dropped automatically since they are never sent again
+        self.chat_history: deque[dict]=deque(maxlen=self.MAX_CHAT_CONTEXT)
         self.session_mode='agent' # Default mode: agent
         
         # --- NEW: Temporary model override state ---
         self.temp_model_override: str | None=None
 
+        # History saves are coalesced: submits only mark it dirty, a timer flushes it to disk.
+        # New commands are appended to the JSONL file; it is compacted once it grows too long.
+        self._history_dirty=False
+        self._pending_history: list[str]=[]
+        self._history_lines_on_disk=0
+        self._history_needs_rewrite=False
+
+        # Rendered options panel, reused until the config/permissions versions change
+        self._options_menu_cache: str | None=None
+        self._options_menu_key: tuple[int, int] | None=None
+
+        # Model names for /model autocompletion: (names, time.monotonic() of the last refresh).
+        # Refreshed by a thread worker so a keystroke never waits on the Ollama API.
+        self._ollama_models_cache: tuple[list[str], float]=([], 0.0)
+        self._ollama_models_refreshing=False
+
+        # Long-lived widgets, assigned in compose (input) and on_mount (options panel, grid)
+        self._input_widget: Input | None=None
+        self._options_panel: Static | None=None
+        self._app_grid: Container | None=None
+        # Last placeholder set through _set_placeholder (compose starts with sub_title)
+        self._last_placeholder=self.sub_title
+
+        # Agent status lines are collected here and written to the log in one batch (see _flush_log)
+        self._log_buffer: list[str]=[]
+
+        # error.log entries are queued here and appended by a single daemon thread (see _drain_error_log),
+        # so failure paths never wait on the disk. None is the shutdown sentinel.
+        self._error_log_queue: queue.Queue[list[str] | None]=queue.Queue()
+        self._error_log_thread=threading.Thread(target=self._drain_error_log, name="error-log", daemon=True)
+        self._error_log_thread.start()
+
     # --- Utility Methods ---
 
-    def _load_history(self):
-        """Loads command history from file."""
-        if HISTORY_FILE.exists():
+    def _load_history(self) -> tuple[list[str], int, bool]:
+        """
+        Loads command history from file (JSONL: one JSON string per line, oldest first).
+        Returns (commands, lines_on_disk, needs_rewrite). needs_rewrite is set for the
+        legacy single-JSON-array format and for unreadable lines, so the next flush rewrites the file.
+        """
+        try:
+            # Bytes go straight to json_loads (orjson when installed), no str decode step
+            raw=HISTORY_FILE.read_bytes()
+        except IOError:
+            return [], 0, False
+
+        if raw.lstrip().startswith(b'['):
+            # Legacy history.json written as one indented list
+            try:
+                return list(json_loads(raw)), 0, True
+            except ValueError:
+                return [], 0, True
+
+        commands=[]
+        needs_rewrite=False
+        lines=raw.splitlines()
+        for line in lines:
+            if not line:
+                continue
             try:
-                with open(HISTORY_FILE, 'r') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError):
-                return []
-        return []
+                commands.append(json_loads(line))
+            except ValueError:
+                needs_rewrite=True # e.g. a torn final line
+        return commands, len(lines), needs_rewrite
 
     def _save_history(self):
-        """Saves command history to file."""
+        """Marks command history for saving; the periodic flush does the actual write."""
+        self._history_dirty=True
+
+    def _write_history(self, pending: list[str], snapshot: list[str] | None):
+        """
+        Blocking history write. Appends one line per pending command, or - when snapshot is given -
+        compacts the file by atomically rewriting it with just the snapshot. Raises IOError on failure.
+        """
+        if snapshot is not None:
+            atomic_write_bytes(HISTORY_FILE, b"".join(json_dumps(cmd) + b"\n" for cmd in snapshot))
+        elif pending:
+            with open(HISTORY_FILE, 'ab') as f:
+                f.write(b"".join(json_dumps(cmd) + b"\n" for cmd in pending))
+
+    def _take_history_flush(self) -> tuple[list[str], list[str] | None] | None:
+        """
+        Collects what the next history write must do and resets the dirty state.
+        Returns None when there is nothing to write (or the file has not been loaded yet).
+        """
+        # Never touch the file before its contents have been merged in
+        if not self._history_dirty or not self._history_loaded:
+            return None
+        self._history_dirty=False
+        pending, self._pending_history=self._pending_history, []
+
+        # Appends grow the file without bound; rewrite it once it is ~10x the kept history
+        snapshot=None
+        if self._history_needs_rewrite or self._history_lines_on_disk + len(pending) > 10 * self.MAX_HISTORY_ENTRIES:
+            snapshot=list(self.command_history)
+            self._history_lines_on_disk=len(snapshot)
+            self._history_needs_rewrite=False
+        else:
+            self._history_lines_on_disk+=len(pending)
+        return pending, snapshot
+
+    async def _prewarm_history(self):
+        """Loads command history in a thread and merges it ahead of anything typed meanwhile."""
+        loaded, lines_on_disk, needs_rewrite=await asyncio.to_thread(self._load_history)
+        # The append-only file can hold a command more than once (re-entered after it was trimmed);
+        # keep its latest position so _trim_history does not drop the most recent commands
+        newest_last=list(dict.fromkeys(reversed(loaded)))[::-1]
+        older=[cmd for cmd in newest_last if cmd not in self._history_set]
+        self.command_history[:0]=older
+        self._history_set.update(older)
+        self._trim_history()
+        self._history_lines_on_disk=lines_on_disk
+        self._history_needs_rewrite=needs_rewrite
+        if needs_rewrite:
+            self._save_history()
+        self._history_loaded=True
+
+    def _add_to_history(self, command: str):
+        """Appends a new unique command and schedules a save."""
+        if command in self._history_set:
+            return
+        self._history_set.add(command)
+        self.command_history.append(command)
+        self._pending_history.append(command)
+        self._trim_history()
+        self._save_history()
+
+    def _trim_history(self):
+        """Keeps only the newest MAX_HISTORY_ENTRIES commands (in place; the Input widget shares the list)."""
+        excess=len(self.command_history) - self.MAX_HISTORY_ENTRIES
+        if excess > 0:
+            self._history_set.difference_update(self.command_history[:excess])
+            del self.command_history[:excess]
+
+    async def _flush_history_if_dirty(self):
+        """Writes pending history changes off the event loop (runs on a timer and at quit)."""
+        work=self._take_history_flush()
+        if work is None:
+            return
         try:
-            with open(HISTORY_FILE, 'w') as f:
-                # Only save the last 50 unique commands
-                history_to_save=list(dict.fromkeys(self.command_history))[-50:]
-                json.dump(history_to_save, f, indent=4)
+            await asyncio.to_thread(self._write_history, *work)
         except IOError as e:
+            # Rewrite the whole file next time rather than losing the pending entries
+            self._history_needs_rewrite=True
             self.log_display.write(f"[ERROR] Failed to save history file: {e}")
 
-    def _log_error_to_file(self, summary: str, exception: Exception | None=None):
+    def _log_error_to_file(self, summary: str, exception: Exception | None=None, message: str | None=None, notify: bool=True) -> None:
         """
         Writes detailed error information to error.log in the current working directory.
+        The entry is queued for the error-log thread, so a slow disk never stalls the UI or the agent loop.
+        The user is told with one TUI write: message (the caller's own error line, if given) followed by
+        the log-file notice. notify=False leaves telling the user to the caller.
         """
         timestamp=time.strftime("%Y-%m-%d %H:%M:%S")
                 
-        log_entry=[f"--- ERROR LOG ENTRY --- ({timestamp})", f"SUMMARY: {summary}"]
+        # One string per line (newline included) so the entry can be written with writelines
+        log_lines=[f"--- ERROR LOG ENTRY --- ({timestamp})\n", f"SUMMARY: {summary}\n"]
                 
         if exception:
-            log_entry.append(f"EXCEPTION TYPE: {type(exception).__name__}")
-            log_entry.append(f"EXCEPTION DETAIL: {str(exception)}")
+            log_lines.append(f"EXCEPTION TYPE: {type(exception).__name__}\n")
+            log_lines.append(f"EXCEPTION DETAIL: {str(exception)}\n")
                         
-            tb=traceback.format_exc()
-            if "Traceback (most recent call last)" in tb and len(tb.strip()) > 50:
-                log_entry.append("FULL TRACEBACK:\n" + tb)
+            # Format the exception's own traceback instead of format_exc(), which depends on
+            # being called inside the except block (and costs a formatting pass when it isn't)
+            if exception.__traceback__ is not None:
+                log_lines.append("FULL TRACEBACK:\n")
+                log_lines.extend(traceback.format_exception(type(exception), exception, exception.__traceback__))
             else:
-                log_entry.append("No detailed Python traceback available from current context.")
+                log_lines.append("No detailed Python traceback available from current context.\n")
 
-        log_content="\n".join(log_entry) + "\n\n"
-                
+        log_lines.append("\n")
+
+        self._error_log_queue.put_nowait(log_lines)
+
+        if notify:
+            notice=f"[STATUS] Detailed error logged to {ERROR_LOG_FILE.name}"
+            self._safe_log.write(notice if message is None else f"{message}\n{notice}")
+
+    def _drain_error_log(self):
+        """
+        Error-log thread: appends queued entries to error.log until the None sentinel arrives.
+        Entries are batched (up to _ERROR_LOG_BATCH, or _ERROR_LOG_LINGER seconds) and written with
+        one writelines + flush per batch. The file is opened on the first entry and kept open.
+        """
+        log_file=None
+        stopping=False
         try:
-            with open(ERROR_LOG_FILE, 'a') as f:
-                f.write(log_content)
-            self.log_display.write(f"[STATUS] Detailed error logged to {ERROR_LOG_FILE.name}")
-        except IOError as e:
-            print(f"FATAL: Could not write to error.log: {e}")
+            while not stopping:
+                entry=self._error_log_queue.get()
+                if entry is None:
+                    break
+                batch=[entry]
+                deadline=time.monotonic() + _ERROR_LOG_LINGER
+                while len(batch) < _ERROR_LOG_BATCH:
+                    remaining=deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        entry=self._error_log_queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if entry is None:
+                        stopping=True
+                        break
+                    batch.append(entry)
+
+                try:
+                    if log_file is None:
+                        log_file=open(ERROR_LOG_FILE, 'a')
+                    for log_lines in batch:
+                        log_file.writelines(log_lines)
+                    log_file.flush()
+                except IOError as e:
+                    print(f"FATAL: Could not write to error.log: {e}")
+                    if log_file is not None:
+                        log_file.close()
+                    log_file=None # Reopen on the next batch
+        finally:
+            if log_file is not None:
+                log_file.close()
+
+    def _get_ollama_models_cached(self) -> list[str]:
+        """Returns the last known Ollama model list, scheduling a background refresh when it is stale."""
+        models, fetched_at=self._ollama_models_cache
+        if time.monotonic() - fetched_at >= _MODEL_SUGGESTIONS_TTL and not self._ollama_models_refreshing:
+            self._ollama_models_refreshing=True
+            self.run_worker(self._refresh_ollama_models, thread=True, group="ollama-models")
+        return models
+
+    def _refresh_ollama_models(self):
+        """Thread worker: fetches the model list (ModelManager has its own caches) and stores it for autocompletion."""
+        try:
+            self._ollama_models_cache=(self.model_manager.get_ollama_models(), time.monotonic())
+        finally:
+            self._ollama_models_refreshing=False
 
-    def _parse_tool_calls(self, response_text: str) -> list[tuple[str, dict]]:
+    def _log(self, message: str):
+        """Queues a status line for the next _flush_log instead of writing it right away."""
+        self._log_buffer.append(message)
+
+    def _flush_log(self):
+        """Writes all queued status lines to the log display as a single entry."""
+        if self._log_buffer:
+            self.log_display.write("\n".join(self._log_buffer))
+            self._log_buffer.clear()
+
+    def _iter_tool_calls(self, response_text: str) -> Iterator[tuple[str, dict]]:
         """
-        Parses structured tool calls from the model's response using an XML-like tag.
+        Lazily parses structured tool calls from the model's response using an XML-like tag,
+        yielding (function_name, args) one at a time so callers that only need the first stop early.
         
         CRITICAL FIX: Added handling for HTML entities (&quot;, &amp;).
         """
                 
-        # Regex to find all <tool_call .../> tags
-        tool_call_matches=re.findall(r'<tool_call\s+.*?\s*/>', response_text, re.DOTALL)
-                
-        extracted_tools=[]
-                
-        # Function to safely unescape the most common sequences
-        def unescape_safe(s: str) -> str:
-            """
-            Replaces literal \n, \t, \r, \\ with actual characters,
-            AND reverses common HTML entities used for quote/ampersand.
-            """
-            # 1. Reverse HTML entities (CRITICAL for Python code content)
-            s=s.replace("&quot;", "\"")  # Replaces &quot; with "
-            s=s.replace("&amp;", "&")    # Replaces &amp; with & (if model escapes it)
-
-            # 2. Reverse Agent's backslash escaping (as defined in the prompt)
-            return s.replace("\\n", "\n").replace("\\t", "\t").replace("\\r", "\r").replace("\\\\", "\\")
-
-        for match in tool_call_matches:
-            # Find the function name
-            func_match=re.search(r'function=["\'](write_file|run_code)["\']', match)
-            if not func_match:
-                continue
-                        
-            function_name=func_match.group(1)
+        # Final-answer turns carry no tool call; a substring check is far cheaper than the DOTALL scan
+        if "<tool_call" not in response_text:
+            return
+
+        # Scan for <tool_call .../> tags one at a time
+        for tool_call_match in _TOOL_CALL_RE.finditer(response_text):
+            match=tool_call_match.group(0)
+            # Fast path: a single match captures the function name and every argument
+            combined_match=_WRITE_FILE_RE.match(match) or _RUN_CODE_RE.match(match)
+            if combined_match:
+                function_name=combined_match.group('function')
+                path_match=content_match=command_match=combined_match
+            else:
+                # Find the function name
+                func_match=_FUNC_RE.search(match)
+                if not func_match:
+                    continue
+                function_name=func_match.group(1)
             args={}
                         
             if function_name == "write_file":
-                # Path and Content are required for write_file
-                # Path is usually simple and less likely to contain internal quotes
-                path_match=re.search(r'path=["\'](?P<path>[^"\']+)["\']', match)
-                
-                # --- CRITICAL REGEX FIX for 'content' ---
-                # This regex captures everything after 'content=' until the final quote 
-                # that immediately precedes the closing slash of the XML tag (with optional whitespace).
-                # This makes it robust against internal quotes that are part of the file content.
-                content_match=re.search(r'content=(?P<quote>["\'])(?P<content>.*?)(?P=quote)\s*/>', match, re.DOTALL)
-                # ----------------------------------------
+                if not combined_match:
+                    # Path and Content are required for write_file
+                    # Path is usually simple and less likely to contain internal quotes
+                    path_match=_PATH_RE.search(match)
+                    
+                    # --- CRITICAL REGEX FIX for 'content' ---
+                    # This regex captures everything after 'content=' until the final quote 
+                    # that immediately precedes the closing slash of the XML tag (with optional whitespace).
+                    # This makes it robust against internal quotes that are part of the file content.
+                    content_match=_CONTENT_RE.search(match)
+                    # ----------------------------------------
                         
                 if path_match and content_match:
                     raw_path=path_match.group('path')
@@ -205,36 +535,40 @@ class OwnCLIApp(App):
                     raw_content=content_match.group('content') 
 
                     try:
-                        args['path']=unescape_safe(raw_path)
-                        args['content']=unescape_safe(raw_content)
-                        extracted_tools.append((function_name, args))
-                        
+                        args['path']=_unescape_safe(raw_path)
+                        args['content']=_unescape_safe(raw_content)
+                    except Exception as e:
+                        self._log(f"[PARSER:ERROR] Failed to unescape content/path for write_file: {e}")
+                    else:
                         # --- NEW LOGGING STATUS CHECK ---
+                        # Logged before yielding, since the caller may not resume the generator
                         if "\\n" in raw_content or "\\t" in raw_content:
-                             self.log_display.write("[PARSER:STATUS] Successfully unescaped newline/tab characters in 'content' for `write_file`.")
+                             self._log("[PARSER:STATUS] Successfully unescaped newline/tab characters in 'content' for `write_file`.")
                         # ---------------------------------------------
-
-                    except Exception as e:
-                        self.log_display.write(f"[PARSER:ERROR] Failed to unescape content/path for write_file: {e}")
+                        yield function_name, args
                 else:
-                    self.log_display.write(f"[PARSER:WARN] Incomplete or unparseable write_file call: {match}")
+                    self._log(f"[PARSER:WARN] Incomplete or unparseable write_file call: {match}")
                         
             elif function_name == "run_code":
-                # Command is required for run_code
-                # Command is the last argument, so we use the robust closing check
-                command_match=re.search(r'command=(?P<quote>["\'])(?P<command>.*?)(?P=quote)\s*/>', match, re.DOTALL)
+                if not combined_match:
+                    # Command is required for run_code
+                    # Command is the last argument, so we use the robust closing check
+                    command_match=_CMD_RE.search(match)
                 
                 if command_match:
                     raw_command=command_match.group('command')
                     try:
-                        args['command']=unescape_safe(raw_command)
-                        extracted_tools.append((function_name, args))
+                        args['command']=_unescape_safe(raw_command)
                     except Exception as e:
-                        self.log_display.write(f"[PARSER:ERROR] Failed to unescape command for run_code: {e}")
+                        self._log(f"[PARSER:ERROR] Failed to unescape command for run_code: {e}")
+                    else:
+                        yield function_name, args
                 else:
-                    self.log_display.write(f"[PARSER:WARN] Incomplete or unparseable run_code call: {match}")
+                    self._log(f"[PARSER:WARN] Incomplete or unparseable run_code call: {match}")
 
-        return extracted_tools
+    def _parse_tool_calls(self, response_text: str) -> list[tuple[str, dict]]:
+        """Returns every tool call in the response (see _iter_tool_calls)."""
+        return list(self._iter_tool_calls(response_text))
 
     # --- Textual Lifecycle Hooks ---
 
@@ -245,9 +579,11 @@ class OwnCLIApp(App):
         with Container(id="app-grid"):
             yield Static(self._build_options_menu(), id="options-panel")
                     
+            # Kept on self so handlers don't walk the DOM with query_one on every action
+            self._input_widget=Input(placeholder=self.sub_title, id="main-input")
             yield Container(
                 self.log_display,
-                Input(placeholder=self.sub_title, id="main-input"),
+                self._input_widget,
                 id="main-content"
             )
 
@@ -262,21 +598,62 @@ class OwnCLIApp(App):
         self.screen.styles.background="#1E1E1E"
         self.query_one(Header).styles.color="gold"
 
-        self.log_display.write(f"[WELCOME] Own-CLI Agent V2.0 - Local LLM Agentic CLI\nMade by jnetai.com forum jnet.forumotion.com")
-        self.log_display.write(f"[CONFIG] Project Directory: {TEMP_PROJECT_DIR.relative_to(Path.cwd())}")
-        self.log_display.write(f"[CONFIG] Default Chat Model: {self.config.get_default_model('chat')}")
-        self.log_display.write(f"[CONFIG] Default Agent Model: {self.config.get_default_model('agent')}")
-        self.log_display.write(f"[STATUS] Ready. Use /agent /chat /model before your message.")
+        # These widgets live as long as the app, so look them up once
+        self._options_panel=self.query_one("#options-panel")
+        self._app_grid=self.query_one("#app-grid")
+
+        # Only the config lines vary; the banner and ready line are module constants, written in one entry
+        self.log_display.write("\n".join((
+            _WELCOME_BANNER,
+            f"[CONFIG] Project Directory: {TEMP_PROJECT_DIR.relative_to(Path.cwd())}",
+            f"[CONFIG] Default Chat Model: {self.config.get_default_model('chat')}",
+            f"[CONFIG] Default Agent Model: {self.config.get_default_model('agent')}",
+            _READY_MESSAGE
+        )))
                 
-        # Load history into the input widget
-        input_widget=self.query_one(Input)
+        # Load history into the input widget (populated in the background by _prewarm_history)
+        input_widget=self._input_widget
         input_widget.history=self.command_history
         input_widget.focus()
+        self.run_worker(self._prewarm_history(), group="history")
+        # Fetch the model list now so the first /model completion already has it
+        self._get_ollama_models_cached()
+
+        self.set_interval(2.0, self._flush_history_if_dirty)
+
+    async def action_quit(self) -> None:
+        """Flushes pending history before quitting."""
+        # Stop any streaming model call now; its worker thread would otherwise keep the process alive
+        self.model_manager.cancel()
+        await self._flush_history_if_dirty()
+        await super().action_quit()
+
+    def on_unmount(self) -> None:
+        """Last-chance history flush if the app exits without going through action_quit."""
+        work=self._take_history_flush()
+        if work is not None:
+            try:
+                self._write_history(*work)
+            except IOError as e:
+                print(f"Failed to save history file: {e}")
+
+        # Abandon any stream still being read, then release pooled HTTP connections and the persistent shell
+        self.model_manager.cancel()
+        self.model_manager.close()
+        self.tool_executor.close()
+
+        # Let the error-log thread write out anything still queued
+        self._error_log_queue.put_nowait(None)
+        self._error_log_thread.join(timeout=2)
 
     # --- Menu and Actions ---
 
     def _build_options_menu(self) -> str:
-        """Generates the options menu content."""
+        """Generates the options menu content (cached until config or permissions change)."""
+        cache_key=(self.config.version, self.permissions.version)
+        if self._options_menu_cache is not None and self._options_menu_key == cache_key:
+            return self._options_menu_cache
+
         config_info=[
             f"--- Configuration ({CONFIG_FILE.name}) ---",
             f"Default Chat Model: {self.config.get_default_model('chat')}",
@@ -299,18 +676,20 @@ class OwnCLIApp(App):
             "\n[yellow]EDIT permissions.json TO CHANGE[/yellow]"
         ]
 
-        return "\n".join(config_info + permission_info)
+        self._options_menu_cache="\n".join(config_info + permission_info)
+        self._options_menu_key=cache_key
+        return self._options_menu_cache
 
 
     def action_toggle_options(self) -> None:
         """An action to toggle the options panel display."""
-        options_panel=self.query_one("#options-panel")
+        options_panel=self._options_panel
         options_panel.update(self._build_options_menu())
         # Toggle display property
         new_display="none" if options_panel.styles.display == "block" else "block"
         options_panel.styles.display=new_display
                 
-        app_grid=self.query_one("#app-grid")
+        app_grid=self._app_grid
                 
         # Adjust grid columns based on display state
         if new_display == "block":
@@ -320,23 +699,37 @@ class OwnCLIApp(App):
 
 
     def action_reset_session(self) -> None:
-        """Resets the chat history and logs."""
-        self.chat_history=[]
+        """Resets the chat history and logs, cancelling any query still in flight."""
+        self.workers.cancel_group(self, "query")
+        # Cancelling the worker does not stop its thread; this makes a streaming model call return early
+        self.model_manager.cancel()
+        self._log_buffer.clear()
+        self.chat_history.clear()
+        # A reset should get fresh answers, not replays of cached ones
+        self.model_manager.invalidate()
         self.log_display.clear()
         self.log_display.write("[STATUS] Session and chat history reset.")
-        self.query_one(Input).value=""
-        self.query_one(Input).placeholder=self.sub_title
-        self.query_one(Input).focus()
+        self._input_widget.value=""
+        self._set_placeholder(self.sub_title)
+        self._input_widget.focus()
 
     def action_show_tools(self) -> None:
         """Displays available tools in the log."""
-        tools_info=[
-            "[AVAILABLE TOOLS]",
-            f"  [bold]run_code[/bold]: Executes shell commands. Requires 'allow_code_execution': {self.permissions.is_allowed('allow_code_execution')}",
-            f"  [bold]write_file[/bold]: Writes content to the project folder. Requires 'allow_file_io': {self.permissions.is_allowed('allow_file_io')}",
-            "[STATUS] Use /agent to enable tool calling mode."
-        ]
-        self.log_display.write("\n".join(tools_info))
+        self.log_display.write(_TOOLS_INFO_TEMPLATE.format(
+            allow_code_execution=self.permissions.is_allowed('allow_code_execution'),
+            allow_file_io=self.permissions.is_allowed('allow_file_io')
+        ))
+
+    def _set_placeholder(self, text: str | None=None):
+        """
+        Shows text (default: the current mode and model) as the input placeholder.
+        Skips the assignment when nothing changed, since every set refreshes the widget.
+        """
+        if text is None:
+            text=f"Current Mode: /{self.session_mode} (Model: {self._get_current_model(self.session_mode)})"
+        if text != self._last_placeholder:
+            self._input_widget.placeholder=text
+            self._last_placeholder=text
 
     # --- NEW MODEL HELPER ---
     def _get_current_model(self, mode: str) -> str:
@@ -364,7 +757,7 @@ class OwnCLIApp(App):
                 return
 
             model_name=prompt
-            if model_name in ("reset", "clear", "default"):
+            if model_name in _RESET_TOKENS:
                 self.temp_model_override=None
                 self.log_display.write("Model override cleared. Reverting to default configuration.")
             else:
@@ -372,7 +765,7 @@ class OwnCLIApp(App):
                 self.log_display.write(f"Temporary model switched to: [bold cyan]{model_name}[/bold cyan] for both chat and agent modes.")
             
             # Update placeholder immediately
-            self.query_one(Input).placeholder=f"Current Mode: /{self.session_mode} (Model: {self._get_current_model(self.session_mode)})"
+            self._set_placeholder()
             return
             
         # 2. Handle /chat and /agent
@@ -382,7 +775,7 @@ class OwnCLIApp(App):
             self.session_mode='agent'
         
         # Determine the final prompt and mode
-        if command.startswith("/") and command not in ["/chat", "/agent"]:
+        if command.startswith("/") and command not in _COMMAND_SET:
             # Treat unknown command as part of the prompt in the current mode
             mode_to_use=self.session_mode
             prompt_to_use=user_input
@@ -397,22 +790,25 @@ class OwnCLIApp(App):
         # 3. Determine the model to use
         model_to_use=self._get_current_model(mode_to_use)
             
-        # 4. Execute based on mode
+        # 4. Execute based on mode. The handlers run as workers so the UI stays responsive;
+        # exclusive=True cancels a query that is still running when a new one is submitted;
+        # cancel() also stops that query's model stream, which the worker cancellation cannot reach.
+        self.model_manager.cancel()
         if mode_to_use == 'chat':
-            self._handle_chat_query(model_to_use, prompt_to_use)
+            self.run_worker(self._handle_chat_query(model_to_use, prompt_to_use), group="query", exclusive=True)
         elif mode_to_use == 'agent':
-            self._handle_agent_query(model_to_use, prompt_to_use)
+            self.run_worker(self._handle_agent_query(model_to_use, prompt_to_use), group="query", exclusive=True)
             
         # Update placeholder at the end
-        self.query_one(Input).placeholder=f"Current Mode: /{self.session_mode} (Model: {model_to_use})"
-        self.query_one(Input).focus()
+        self._set_placeholder()
+        self._input_widget.focus()
 
     # --- Input Handling and Core Agent Logic ---
     
     def on_input_submitted(self, message: Input.Submitted) -> None:
         """Handle input submission from the user."""
         user_input=message.value.strip()
-        self.query_one(Input).value="" # Clear input immediately
+        self._input_widget.value="" # Clear input immediately
                 
         if not user_input:
             return
@@ -420,9 +816,7 @@ class OwnCLIApp(App):
         self.log_display.write(f"[YOU] {user_input}")
 
         # Add command to history list
-        if user_input not in self.command_history:
-            self.command_history.append(user_input)
-            self._save_history()
+        self._add_to_history(user_input)
 
         # --- UPDATED: Use the new command processor for all command logic ---
         self.action_process_command(user_input)
@@ -436,7 +830,7 @@ class OwnCLIApp(App):
         """
         user_input=event.value
         suggestions=[]
-        input_widget=self.query_one(Input)
+        input_widget=self._input_widget
         
         if user_input.startswith("/"):
             
@@ -448,9 +842,8 @@ class OwnCLIApp(App):
                 # If the input is just '/model' or '/model ' (as in the crash), parts[1] doesn't exist.
                 typed_fragment=parts[1] if len(parts) > 1 else ""
                 
-                # Assumes ModelManager.get_ollama_models() is implemented 
-                # to return a list of local models (e.g., from 'ollama ls')
-                models=self.model_manager.get_ollama_models() 
+                # Cached list (possibly stale); a refresh runs in the background when needed
+                models=self._get_ollama_models_cached()
                 
                 # Include the 'reset' command
                 all_model_options=["reset"] + models
@@ -465,8 +858,8 @@ class OwnCLIApp(App):
 
             else:
                 # Basic command completion (/chat, /agent)
-                all_commands=["/chat", "/agent", "/model"]
-                suggestions=[cmd for cmd in all_commands if cmd.startswith(user_input.lower())]
+                typed=user_input.lower()
+                suggestions=[cmd for cmd in _COMMANDS if cmd.startswith(typed)]
                 input_widget.suggestions=suggestions
                 
         else:
@@ -474,21 +867,22 @@ class OwnCLIApp(App):
             input_widget.suggestions=[]
 
 
-    def _handle_chat_query(self, model_name: str, prompt: str):
+    async def _handle_chat_query(self, model_name: str, prompt: str):
         """Processes a query in simple chat mode (no tools)."""
         hide_think=True
                 
         self.chat_history.append({"role": "user", "content": prompt})
                 
-        # Limit context to the last 5 messages for simple chat
-        context_messages=self.chat_history[-5:]
+        # Limit context to the last MAX_CHAT_CONTEXT messages for simple chat (the deque holds exactly those)
+        context_messages=list(self.chat_history)
                 
-        response_text=self.model_manager.call_model(model_name, context_messages, mode='chat')
+        # Blocking HTTP call, run off the event loop
+        response_text=await self.model_manager.acall_model(model_name, context_messages, mode='chat')
                 
         if not response_text.startswith("ERROR"):
             # Conditionally strip the <think> tags
             if hide_think:
-                response_text=re.sub(r'<think>.*?</think>', '', response_text, flags=re.DOTALL).strip()
+                response_text=_strip_think(response_text)
                         
             self.chat_history.append({"role": "assistant", "content": response_text})
             self.log_display.write(f"[ASSISTANT] {response_text}")
@@ -496,89 +890,78 @@ class OwnCLIApp(App):
             self.log_display.write(f"[ERROR] Chat failed: {response_text}")
 
         # Ensure the input placeholder reflects the chat's current model
-        current_model=self._get_current_model(self.session_mode)
-        self.query_one(Input).placeholder=f"Current Mode: /{self.session_mode} (Model: {current_model})"
+        self._set_placeholder()
 
 
-    def _handle_agent_query(self, model_name: str, prompt: str):
+    async def _handle_agent_query(self, model_name: str, prompt: str):
         """Processes a query in agentic (tool-using) mode."""
-        self.log_display.write("[AGENT:INFO] Starting agent cycle...")
-
-        # 1. Initialize messages with a robust system prompt
-        system_prompt=(
-            "You are an expert CLI agent. Your goal is to satisfy the user's request using tools. "
-            "You MUST strictly adhere to the following rules:\n\n"
-            "1. **TOOL USAGE (CRITICAL):** Output ONLY ONE single, self-closing XML tag per turn. "
-            "   It MUST be in the form: <tool_call function=\"TOOL_NAME\" ARG1=\"value\" ARG2=\"value\"/>. "
-            "   **NEVER** use separate opening and closing tags (e.g., `<tool_call>...</tool_call>`).\n"
-            "2. **ESCAPING (CRITICAL):** Arguments MUST use double quotes. For `write_file` content, "
-            "   use **literal backslash sequences**:\n"
-            "   - **Newline (`\\n`)** MUST be `\\\\n`.\n"
-            "   - **Tab (`\\t`)** MUST be `\\\\t`.\n"
-            "3. **AVAILABLE TOOLS:**\n"
-            "   - [bold]write_file[/bold](path, content): Writes Python/script code. Content **must** be escaped and provided as a single attribute value.\n"
-            "   - [bold]run_code[/bold](command): Executes shell commands (e.g., `python file.py`).\n"
-            
-            # --- CRITICALLY UPDATED CODE OUTPUT MANDATE ---
-            "4. **CODE OUTPUT MANDATE (CRITICAL):** All code that returns a value intended for the user MUST be wrapped in an explicit `print()` call to ensure the output is written to STDOUT (e.g., `print(function_name())`). If the code doesn't output to STDOUT, the agent fails.\n"
-            
-            "5. **DEBUG MANDATE (CRITICAL):** Treat any `TOOL:ERROR`, `PARSER:ERROR`, or **EMPTY/WHITESPACE-ONLY** output from `run_code` as a failure. Your immediate next step **MUST** be to rewrite the file to correct the logic (e.g., adding the missing `print()`). **DO NOT** attempt to justify or declare success when the output is empty.\n"
-            "6. **AUTONOMY:** Do not ask for human permission. Persist until the mission is validated and fully completed. Stop only with a final, non-tool answer."
-        )
+        # Drop lines left behind by a cancelled run
+        self._log_buffer.clear()
+        self._log("[AGENT:INFO] Starting agent cycle...")
 
         messages=[
-            {"role": "system", "content": system_prompt},
+            # 1. The system prompt is a module constant (see _AGENT_SYSTEM_MESSAGE)
+            _AGENT_SYSTEM_MESSAGE,
             {"role": "user", "content": prompt}
         ]
         
         # 2. Start execution loop (max MAX_AGENT_STEPS)
         for step in range(1, self.MAX_AGENT_STEPS + 1):
-            self.log_display.write(f"[AGENT:STEP {step}] Reasoning and calling model...")
+            self._log(f"[AGENT:STEP {step}] Reasoning and calling model...")
             
-            # Get response from model
-            response_text=self.model_manager.call_model(model_name, messages, mode='agent')
+            # Get response from model. ModelManager writes its own status lines, so flush ours first
+            # to keep them in order (this also batches the previous step's tool output with this banner).
+            self._flush_log()
+            response_text=await self.model_manager.acall_model(model_name, messages, mode='agent')
 
             if response_text.startswith("ERROR"):
-                self.log_display.write(f"[AGENT:ERROR] Model call failed: {response_text}")
+                self._log(f"[AGENT:ERROR] Model call failed: {response_text}")
                 break
 
             # Add model's thought/response to history
             messages.append({"role": "assistant", "content": response_text})
 
             # 3. Parse and Execute Tools
-            tool_calls=self._parse_tool_calls(response_text)
+            # Only the first tool call is executed, so stop parsing once it is found
+            first_call=next(self._iter_tool_calls(response_text), None)
 
-            if not tool_calls:
+            if first_call is None:
                 # No tool call found - this is the final answer
-                final_answer=re.sub(r'<think>.*?</think>', '', response_text, flags=re.DOTALL).strip()
+                final_answer=_strip_think(response_text)
+                self._flush_log()
                 self.log_display.write(f"[ASSISTANT] {final_answer}")
                 break # Exit the loop after providing the final answer
 
             # If tool calls are present, execute the first one
-            function_name, args=tool_calls[0]
-            self.log_display.write(f"[AGENT:TOOL CALL] {function_name} with args: {', '.join(f'{k}=...' for k in args.keys())}")
+            function_name, args=first_call
+            self._log(f"[AGENT:TOOL CALL] {function_name} with args: {', '.join(f'{k}=...' for k in args.keys())}")
             
+            # ToolExecutor logs directly as well
+            self._flush_log()
             tool_output=""
             if function_name == "write_file":
-                tool_output=self.tool_executor.write_file(**args)
+                tool_output=await asyncio.to_thread(self.tool_executor.write_file, **args)
             elif function_name == "run_code":
-                tool_output=self.tool_executor.run_code(**args)
+                tool_output=await asyncio.to_thread(self.tool_executor.run_code, **args)
                 
             # 4. Add tool output back to the conversation for the next step
             messages.append({"role": "tool", "content": tool_output})
-            self.log_display.write(f"[AGENT:TOOL OUTPUT] {tool_output.splitlines()[0]}...") # Log the first line of the output for conciseness
+            self._log(f"[AGENT:TOOL OUTPUT] {tool_output.splitlines()[0]}...") # Log the first line of the output for conciseness
 
             # 5. Check for Max Steps
             if step == self.MAX_AGENT_STEPS:
-                self.log_display.write(f"[AGENT:WARN] Maximum steps ({self.MAX_AGENT_STEPS}) reached. Terminating.")
+                self._log(f"[AGENT:WARN] Maximum steps ({self.MAX_AGENT_STEPS}) reached. Terminating.")
                 messages.append({"role": "tool", "content": f"AGENT:WARN: Maximum steps ({self.MAX_AGENT_STEPS}) reached. Provide a final summary of progress."})
                 # Re-call the model one last time to get a summary response (final answer mode)
-                response_text=self.model_manager.call_model(model_name, messages, mode='agent')
-                final_answer=re.sub(r'<think>.*?</think>', '', response_text, flags=re.DOTALL).strip()
+                self._flush_log()
+                response_text=await self.model_manager.acall_model(model_name, messages, mode='agent')
+                final_answer=_strip_think(response_text)
                 self.log_display.write(f"[ASSISTANT] {final_answer}")
                 break
+
+        # Anything still queued (e.g. a model error that ended the loop)
+        self._flush_log()
                 
         # Ensure the input placeholder reflects the agent's current mode
-        current_model=self._get_current_model(self.session_mode)
-        self.query_one(Input).placeholder=f"Current Mode: /{self.session_mode} (Model: {current_model})"
-        self.query_one(Input).focus()
+        self._set_placeholder()
+        self._input_widget.focus()
@@ -1,7 +1,43 @@
 # config.py
 
 import json
+import os
 from pathlib import Path
+from types import MappingProxyType
+
+# Prefer orjson for (de)serialization when it is installed; the stdlib json module is the fallback.
+# Both accept raw bytes, so callers can skip the str decode step.
+try:
+    import orjson
+
+    json_loads=orjson.loads
+
+    def json_dumps(obj, indent: bool=False) -> bytes:
+        """Serializes obj to UTF-8 JSON bytes (2-space indented when indent=True)."""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+
+except ImportError:
+    json_loads=json.loads
+
+    def json_dumps(obj, indent: bool=False) -> bytes:
+        """Serializes obj to UTF-8 JSON bytes (2-space indented when indent=True)."""
+        if indent:
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def atomic_write_bytes(path: Path, data: bytes, durable: bool=False):
+    """
+    Writes data to path through a sibling temp file and os.replace, so a crash mid-write
+    never leaves a truncated file behind. fsync is skipped unless durable=True.
+    """
+    tmp_path=path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 # --- GLOBAL CONSTANTS ---
 
@@ -11,14 +47,18 @@ CONFIG_FILE=CONFIG_DIR / "config.json"
 PERMISSIONS_FILE=CONFIG_DIR / "permissions.json"
 MEMORIES_FILE=CONFIG_DIR / "memories.json"
 HISTORY_FILE=CONFIG_DIR / "history.json"
+CACHE_DIR=CONFIG_DIR / "cache"
+OLLAMA_MODELS_CACHE_FILE=CACHE_DIR / "ollama_models.json"
 # ERROR_LOG_FILE is kept in the main application's working directory
 ERROR_LOG_FILE=Path.cwd() / "error.log"
 TEMP_PROJECT_DIR=Path.cwd() / "project_folder"
 
 # NOTE: Model defaults changed to use the user's available deepseek model for chat.
-DEFAULT_CONFIG={
-    "providers": [
-        {
+# The defaults are read-only (MappingProxyType / tuple) so they can be shared safely;
+# use _default_config() to get a mutable copy.
+DEFAULT_CONFIG=MappingProxyType({
+    "providers": (
+        MappingProxyType({
             "name": "Ollama Local",
             "enabled": True,
             "type": "ollama",
@@ -27,26 +67,45 @@ DEFAULT_CONFIG={
             "agent_model": "llama3.1:8b:latest",
             "image_model": "llava-phi3:latest",
             "api_key": "NA"
-        },
-    ],
+        }),
+    ),
     "default_chat_model": "deepseek-r1:7b",
     "default_agent_model": "llama3.1:8b:latest",
-}
+    # Seconds the on-disk Ollama model list stays fresh before it is re-fetched
+    "ollama_models_cache_ttl": 86400,
+    # Reuse chat answers for paraphrased prompts (needs the optional sentence-transformers package)
+    "semantic_cache": False,
+})
 
-DEFAULT_PERMISSIONS={
+DEFAULT_PERMISSIONS=MappingProxyType({
     "allow_file_io": True,
     "allow_code_execution": True,
     "allow_auto_browse": True,
     "allow_host_control": True
-}
+})
+
+
+def _default_providers() -> list[dict]:
+    """Returns a mutable copy of the default providers list."""
+    return [dict(provider) for provider in DEFAULT_CONFIG["providers"]]
+
+
+def _default_config() -> dict:
+    """Returns a mutable copy of DEFAULT_CONFIG."""
+    return {**DEFAULT_CONFIG, "providers": _default_providers()}
 
 # --- CONFIGURATION CLASSES ---
 
 class ConfigManager:
     """Handles reading and writing the configuration file."""
     def __init__(self):
-        self.config=DEFAULT_CONFIG.copy()
+        self.config=None # Assigned by _load_config, from file or a private copy of the defaults
         self.config_loaded=False
+        # Bumped on every (re)load or mark_dirty() so views derived from the config know to rebuild
+        self.version=0
+        # model name -> provider and provider type -> provider lookups, rebuilt whenever the config is (re)loaded
+        self._model_index: dict[str, dict]={}
+        self._type_index: dict[str, dict]={}
         # NOTE: _ensure_config_dir is now called inside __init__ to manage paths
         self._ensure_config_dir()
         self._load_config()
@@ -58,40 +117,75 @@ class ConfigManager:
 
     def _load_config(self):
         """Load configuration from file or use defaults."""
-        if CONFIG_FILE.exists():
-            try:
-                with open(CONFIG_FILE, 'r') as f:
-                    loaded_config=json.load(f)
-                    # Merge loaded config with defaults, preserving the 'providers' list structure
-                    self.config={**DEFAULT_CONFIG, **loaded_config}
-                    if 'providers' in loaded_config:
-                        self.config['providers']=loaded_config['providers']
-                    self.config_loaded=True
-            except json.JSONDecodeError:
-                print(f"Warning: Could not decode {CONFIG_FILE}. Using default config.")
-                self._save_config()
-            except IOError:
-                self._save_config()
-        else:
+        # Open directly rather than probing with exists() first; a missing file
+        # (first run) is handled by the IOError branch like any other read failure.
+        try:
+            loaded_config=json_loads(CONFIG_FILE.read_bytes())
+            # Merge loaded config with defaults, preserving the 'providers' list structure
+            self.config={**DEFAULT_CONFIG, **loaded_config}
+            if 'providers' not in loaded_config:
+                # Never share the module-level providers list with a live config
+                self.config['providers']=_default_providers()
+            self.config_loaded=True
+        except json.JSONDecodeError:
+            print(f"Warning: Could not decode {CONFIG_FILE}. Using default config.")
+            self.config=_default_config()
             self._save_config()
+        except IOError:
+            self.config=_default_config()
+            self._save_config()
+
+        self._index_providers()
+        self.version+=1
+
+    def mark_dirty(self):
+        """Call after mutating self.config in place; refreshes lookups and invalidates cached views."""
+        self._index_providers()
+        self.version+=1
+
+    def _index_providers(self):
+        """
+        Rebuild the model name / provider type indexes used by get_provider and get_provider_by_type,
+        and precompute the Ollama endpoint URLs so they are not re-derived on every call.
+        Derived keys start with '_' and are never written back to config.json.
+        """
+        self._model_index={}
+        self._type_index={}
+        for provider in self.config.get("providers", []):
+            if provider.get("type") == "ollama" and "base_url" in provider:
+                # Tolerate base URLs that already point at an /api/... endpoint
+                root_url=provider["base_url"].split("/api/")[0]
+                provider["_chat_url"]=f"{root_url}/api/chat"
+                provider["_tags_url"]=f"{root_url}/api/tags"
+            if not provider.get("enabled"):
+                continue
+            # First enabled provider of each type wins, matching the old linear scan
+            self._type_index.setdefault(provider.get("type"), provider)
+            for key in ("chat_model", "agent_model", "image_model"):
+                model_name=provider.get(key)
+                if model_name is not None:
+                    # First enabled provider wins, matching the old linear scan
+                    self._model_index.setdefault(model_name, provider)
 
     def _save_config(self):
         """Save the current configuration to file."""
         try:
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(self.config, f, indent=4)
+            # Leave out the derived '_*' provider keys added by _index_providers
+            config_to_save={
+                **self.config,
+                "providers": [
+                    {k: v for k, v in provider.items() if not k.startswith("_")}
+                    for provider in self.config.get("providers", [])
+                ]
+            }
+            # Encode once and issue a single write instead of one per token
+            atomic_write_bytes(CONFIG_FILE, json_dumps(config_to_save, indent=True))
         except IOError as e:
             print(f"Error saving config file {CONFIG_FILE}: {e}")
 
     def get_provider(self, model_name):
         """Find the provider configuration for a given model name."""
-        for provider in self.config.get("providers", []):
-            if provider.get("enabled"):
-                if (provider.get("chat_model") == model_name or 
-                    provider.get("agent_model") == model_name or 
-                    provider.get("image_model") == model_name):
-                    return provider
-        return None
+        return self._model_index.get(model_name)
 
     def get_default_model(self, mode):
         """Get the default model name for a given mode ('chat' or 'agent')."""
@@ -103,41 +197,43 @@ class ConfigManager:
         Retrieves the first enabled provider matching the specified type (e.g., 'ollama').
         Returns the provider dictionary or None if not found/enabled.
         """
-        for provider in self.config.get('providers', []):
-            if provider.get('type') == provider_type and provider.get('enabled', False):
-                return provider
-        return None
+        return self._type_index.get(provider_type)
 
         
 class PermissionsManager:
     """Handles reading and writing the permissions file."""
     def __init__(self):
-        self.permissions=DEFAULT_PERMISSIONS.copy()
+        self.permissions=None # Assigned by _load_permissions
+        # Bumped on every (re)load or mark_dirty() so views derived from the permissions know to rebuild
+        self.version=0
         self._load_permissions()
 
     def _load_permissions(self):
         """Load permissions from file or use defaults."""
-        if PERMISSIONS_FILE.exists():
-            try:
-                with open(PERMISSIONS_FILE, 'r') as f:
-                    loaded_permissions=json.load(f)
-                    self.permissions={
-                        key: loaded_permissions.get(key, DEFAULT_PERMISSIONS[key])
-                        for key in DEFAULT_PERMISSIONS
-                    }
-            except json.JSONDecodeError:
-                print(f"Warning: Could not decode {PERMISSIONS_FILE}. Using default permissions.")
-                self._save_permissions()
-            except IOError:
-                self._save_permissions()
-        else:
+        try:
+            loaded_permissions=json_loads(PERMISSIONS_FILE.read_bytes())
+            # Start from the defaults and overlay only the keys we know about
+            self.permissions=DEFAULT_PERMISSIONS.copy()
+            self.permissions.update({k: v for k, v in loaded_permissions.items() if k in DEFAULT_PERMISSIONS})
+        except json.JSONDecodeError:
+            print(f"Warning: Could not decode {PERMISSIONS_FILE}. Using default permissions.")
+            self.permissions=DEFAULT_PERMISSIONS.copy()
+            self._save_permissions()
+        except IOError:
+            # Includes FileNotFoundError on first run
+            self.permissions=DEFAULT_PERMISSIONS.copy()
             self._save_permissions()
 
+        self.version+=1
+
+    def mark_dirty(self):
+        """Call after mutating self.permissions in place to invalidate cached views."""
+        self.version+=1
+
     def _save_permissions(self):
         """Save the current permissions to file."""
         try:
-            with open(PERMISSIONS_FILE, 'w') as f:
-                json.dump(self.permissions, f, indent=4)
+            atomic_write_bytes(PERMISSIONS_FILE, json_dumps(self.permissions, indent=True))
         except IOError as e:
             print(f"Error saving permissions file {PERMISSIONS_FILE}: {e}")
 
@@ -1,11 +1,32 @@
 # model_manager.py
 
-import json
+import asyncio
+import hashlib
+import re
+import threading
 import time
-import requests
-import traceback
-from requests.exceptions import RequestException, HTTPError
-from .config import TEMP_PROJECT_DIR # Relative import
+from collections import OrderedDict
+# NOTE: requests is imported lazily (see _get_session) - it pulls in urllib3, ssl, idna etc.
+# and is only needed once a model is actually called.
+from .config import TEMP_PROJECT_DIR, OLLAMA_MODELS_CACHE_FILE, atomic_write_bytes, json_loads, json_dumps # Relative import
+
+# Upper bound on remembered (model, messages, temperature) -> response pairs
+_RESPONSE_CACHE_SIZE=128
+# Seconds a cached response stays valid
+_RESPONSE_CACHE_TTL=1800
+# Only the low, chat-mode temperature is deterministic enough to replay a cached answer
+_CACHEABLE_TEMPERATURE=0.3
+
+# Optional semantic cache (config "semantic_cache"): reuse a chat answer when the new prompt's
+# embedding is this close (cosine) to an earlier one for the same model. Needs sentence-transformers.
+_SEMANTIC_CACHE_MODEL="all-MiniLM-L6-v2"
+_SEMANTIC_CACHE_THRESHOLD=0.9
+_SEMANTIC_CACHE_SIZE=256 # Entries kept per model
+
+# Pulls the JSON body out of an Ollama error response for the console log
+_JSON_SNIPPET_RE=re.compile(r'\{.*\}', re.DOTALL)
+# Bytes of an HTTP error body read for that snippet
+_ERROR_BODY_LIMIT=4096
 
 class ModelManager:
     """Manages LLM API calls, handles Ollama, external providers, and response parsing."""
@@ -21,11 +42,81 @@ class ModelManager:
         self._last_ollama_fetch=0
         self._cache_duration=300 # Cache for 5 minutes (300 seconds)
 
+        # Exact-match response cache (LRU with TTL): hash of (model, messages, temperature) -> (stored_at, response text)
+        self._exact_cache: OrderedDict[str, tuple[float, str]]=OrderedDict()
+
+        # Semantic cache: model name -> [(normalized prompt embedding, response text)], oldest first.
+        # The embedder is loaded on first use; False means sentence-transformers is unavailable.
+        self._semantic_index: dict[str, list[tuple[object, str]]]={}
+        self._embedder=None
+
+        # One cancel token per in-flight call_model. cancel() sets every token registered here;
+        # a new call gets a fresh one, so it can never clear a cancel aimed at an older stream.
+        self._cancel_events: set[threading.Event]=set()
+
+        # One keep-alive session for every request so sequential turns reuse the same socket.
+        # Created on first use by _get_session.
+        self._session=None
+
+    def _get_session(self):
+        """Returns the shared requests.Session, importing requests on first use."""
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session=requests.Session()
+            # One adapter shared by both schemes, so remote (https) providers pool connections too
+            adapter=HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            # Static headers are set once here rather than passed with every request
+            session.headers.update({
+                'Connection': 'keep-alive',
+                'Content-Type': 'application/json',
+                'Accept': 'application/json'
+            })
+            self._session=session
+        return self._session
+
+    def cancel(self):
+        """Asks every in-flight call_ollama stream (running in worker threads) to stop reading and return."""
+        for cancel_event in list(self._cancel_events):
+            cancel_event.set()
+
+    def close(self):
+        """Closes the shared session and its pooled connections (called when the app shuts down)."""
+        if self._session is not None:
+            self._session.close()
+            self._session=None
+
+    def _read_models_cache(self, base_url: str) -> tuple[list[str] | None, float]:
+        """
+        Reads the persisted Ollama model list.
+        Returns (model_names, age_in_seconds), or (None, 0) if there is no usable cache for base_url.
+        """
+        try:
+            age=time.time() - OLLAMA_MODELS_CACHE_FILE.stat().st_mtime
+            cached=json_loads(OLLAMA_MODELS_CACHE_FILE.read_bytes())
+        except (OSError, ValueError):
+            return None, 0
+        if not isinstance(cached, dict) or cached.get('base_url') != base_url or not isinstance(cached.get('models'), list):
+            return None, 0
+        return cached['models'], age
+
+    def _write_models_cache(self, base_url: str, model_names: list[str]):
+        """Persists the Ollama model list so fresh CLI sessions can skip the /api/tags round-trip."""
+        payload={"base_url": base_url, "models": model_names, "fetched_at": time.time()}
+        try:
+            OLLAMA_MODELS_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_bytes(OLLAMA_MODELS_CACHE_FILE, json_dumps(payload))
+        except IOError as e:
+            self.log_display.write(f"[MODEL:WARN] Could not write Ollama model cache: {e}")
+
     # --- NEW: Model Discovery for Autocompletion ---
     def get_ollama_models(self) -> list[str]:
         """
         Retrieves a list of available models from the configured Ollama instance.
-        Uses caching to reduce API load.
+        Uses an in-process cache plus an on-disk cache (stale-while-revalidate) to reduce API load.
         """
         ollama_provider=self.config.get_provider_by_type('ollama')
 
@@ -38,108 +129,213 @@ class ModelManager:
             return self._ollama_model_cache
 
         base_url=ollama_provider['base_url']
-        # Use the list endpoint
-        url=f"{base_url}/api/tags"
+
+        # Fresh on-disk copy from an earlier session skips the HTTP call entirely
+        cached_models, cache_age=self._read_models_cache(base_url)
+        cache_ttl=self.config.config.get('ollama_models_cache_ttl', 86400)
+        if cached_models is not None and cache_age < cache_ttl:
+            self._ollama_model_cache=cached_models
+            self._last_ollama_fetch=time.time()
+            return cached_models
+
+        # Use the list endpoint (precomputed from base_url when the config was loaded)
+        url=ollama_provider['_tags_url']
+
+        session=self._get_session()
+        from requests.exceptions import RequestException
 
         try:
-            response=requests.get(url, timeout=10) # Short timeout for listing models
+            response=session.get(url, timeout=10) # Short timeout for listing models
             response.raise_for_status()
             
-            result=response.json()
+            result=json_loads(response.content)
             if 'models' in result:
                 model_names=[m['name'] for m in result['models']]
                 self._ollama_model_cache=model_names
                 self._last_ollama_fetch=time.time()
+                self._write_models_cache(base_url, model_names)
                 return model_names
             
             return []
         
-        except RequestException as e:
+        except (RequestException, ValueError) as e:
             # Log the error to the console, but don't log to file unless critical
             self.log_display.write(f"[MODEL:ERROR] Failed to connect to Ollama for model list: {e}")
+            if cached_models is not None:
+                # Offline fallback: a stale list beats no suggestions at all
+                return cached_models
             return []
     
     # --- API Call Logic ---
 
-    def call_ollama(self, model, messages, provider):
-        """Handles the Ollama API call specifically."""
+    def call_ollama(self, model, messages, provider, temperature=0.3, cancel_event: threading.Event | None=None):
+        """
+        Handles the Ollama API call specifically. The caller picks the temperature (see call_model)
+        and may pass a cancel_event; once it is set the stream is abandoned at the next line.
+        """
                 
         # --- STATUS UPDATE: This is the line that confirms the request is running ---
         self.log_display.write(f"[STATUS] Running your query, please wait...")
                 
-        base_url=provider['base_url']
-                
-        # Ensure URL points to the chat endpoint
-        if '/api/' in base_url:
-            base_url=base_url.split('/api/')[0]
-                    
-        url=f"{base_url}/api/chat"
+        # Chat endpoint precomputed from base_url when the config was loaded
+        url=provider['_chat_url']
                 
-        # CRITICAL: Agent model gets higher temperature
-        # Use a more explicit check for agent mode instead of model name comparison
-        is_agent_mode=messages[0]['role'] == 'system' and 'tool' in messages[0]['content'].lower()
-        temperature=0.7 if is_agent_mode else 0.3
-
         data={
             "model": model,
             "messages": messages,
-            "stream": False,
+            "stream": True,
             "options": {"temperature": temperature}
         }
                 
-        headers={
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        }
-                
+        session=self._get_session()
+        from requests.exceptions import RequestException, HTTPError
+
         try:
-            # The timeout is very long (5920 seconds)
-            response=requests.post(url, headers=headers, json=data, timeout=5920)
+            # The timeout is very long (5920 seconds); it applies per read, not to the whole stream
+            # Body pre-encoded with json_dumps (orjson when installed) instead of requests' stdlib json=;
+            # the session already sends Content-Type: application/json
+            response=session.post(url, data=json_dumps(data), timeout=5920, stream=True)
+            # Raised before the body is consumed so the HTTPError handler can still read the details
             response.raise_for_status()
-                        
-            # Ollama /api/chat response structure
-            result=response.json()
-            if result.get('message') and result['message'].get('content'):
-                return result['message']['content']
+
+            # Ollama streams NDJSON: one {"message": {"content": ...}, "done": ...} object per line.
+            # Lines stay as bytes (no per-chunk str decode); json_loads/orjson parses bytes directly.
+            content_parts=[]
+            with response:
+                for line in response.iter_lines(decode_unicode=False):
+                    if cancel_event is not None and cancel_event.is_set():
+                        # Leaving the with-block closes the connection, so Ollama stops generating
+                        self.log_display.write(f"[MODEL:INFO] Request to {model} cancelled.")
+                        return "ERROR: Request cancelled."
+                    if not line:
+                        continue
+                    chunk=json_loads(line)
+                    if chunk.get('error'):
+                        self.log_display.write(f"[MODEL:ERROR] Ollama stream error: {chunk['error']}")
+                        return f"ERROR: Ollama reported an error for model '{model}': {chunk['error']}"
+                    message=chunk.get('message')
+                    if message and message.get('content'):
+                        content_parts.append(message['content'])
+                    if chunk.get('done'):
+                        break
+
+            if content_parts:
+                return "".join(content_parts)
                         
             return "ERROR: Ollama response format unexpected."
                     
         except HTTPError as e:
             status_code=e.response.status_code if e.response is not None else 'Unknown'
-            error_details=e.response.text if e.response is not None else str(e)
-                    
-            # Log detailed error to file
-            self.app._log_error_to_file(
-                f"Ollama HTTP Error {status_code} for model {model}", 
-                e
-            )
+            if e.response is not None:
+                # Only the first 4 KB of the (still unread, streamed) body is needed for the snippet,
+                # so a huge error page is never downloaded or decoded in full
+                with e.response:
+                    raw_details=next(e.response.iter_content(_ERROR_BODY_LIMIT), b'')
+                error_details=raw_details.decode('utf-8', errors='replace')
+            else:
+                error_details=str(e)
 
             # Extract a snippet of the error detail for the console log
             error_text=error_details.replace('\n', ' ').strip()
             # Use regex to safely extract JSON snippet for display
-            detail_snippet_match=re.search(r'\{.*\}', error_text)
+            detail_snippet_match=_JSON_SNIPPET_RE.search(error_text)
             detail_snippet=detail_snippet_match.group(0) if detail_snippet_match else error_text
 
-            self.log_display.write(f"[MODEL:ERROR] Ollama request failed with HTTP Status {status_code}. Details: {detail_snippet[:100]}...")
+            # Log detailed error to file
+            self.app._log_error_to_file(
+                f"Ollama HTTP Error {status_code} for model {model}",
+                e,
+                f"[MODEL:ERROR] Ollama request failed with HTTP Status {status_code}. Details: {detail_snippet[:100]}..."
+            )
             return f"ERROR: Ollama returned HTTP Status {status_code}. Check if the model '{model}' is pulled and running."
                     
         except RequestException as e:
             # Log detailed error to file
             self.app._log_error_to_file(
-                f"Ollama Connection/Timeout Error to {provider['base_url']}", 
-                e
+                f"Ollama Connection/Timeout Error to {provider['base_url']}",
+                e,
+                f"[MODEL:ERROR] Ollama request failed (Connection/Timeout): {e}"
             )
-
-            self.log_display.write(f"[MODEL:ERROR] Ollama request failed (Connection/Timeout): {e}")
             return f"ERROR: Could not connect to Ollama ({e}). Is 'ollama serve' running?"
 
+        except ValueError as e:
+            # Raw-bytes parsing bypasses requests' own JSONDecodeError (a RequestException)
+            self.app._log_error_to_file(
+                f"Ollama returned invalid JSON for model {model}",
+                e,
+                f"[MODEL:ERROR] Ollama response could not be parsed: {e}"
+            )
+            return "ERROR: Ollama response format unexpected."
+
     def call_external(self, model, messages, provider):
         """Placeholder for external API call logic."""
         self.log_display.write(f"[MODEL:WARNING] External API call requested for {model} but logic is not implemented.")
         return f"ERROR: External API provider '{provider['name']}' not implemented."
 
-    def call_model(self, model_name, messages, mode='chat'):
-        """Main dispatcher for API calls."""
+    def invalidate(self):
+        """Drops every cached response (e.g. after a session reset or a change of tool state)."""
+        self._exact_cache.clear()
+        self._semantic_index.clear()
+
+    def _embed_prompt(self, messages):
+        """
+        Returns the normalized embedding of the user message, or None if the request is not a single
+        user turn or no embedder is available (sentence-transformers is imported lazily - it pulls in torch).
+        Follow-ups are never embedded: "why?" only means something together with the turns before it,
+        and those are not part of the semantic index.
+        """
+        if not messages or messages[-1].get('role') != 'user':
+            return None
+        if any(message.get('role') != 'system' for message in messages[:-1]):
+            return None
+        if self._embedder is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+                self._embedder=SentenceTransformer(_SEMANTIC_CACHE_MODEL)
+            except ImportError:
+                self._embedder=False
+                self.log_display.write("[MODEL:WARN] semantic_cache is enabled but sentence-transformers is not installed. Using exact matching only.")
+            except Exception as e:
+                # e.g. OSError when the model cannot be downloaded (offline, no Hugging Face cache)
+                self._embedder=False
+                self.log_display.write(f"[MODEL:WARN] semantic_cache is enabled but the embedding model could not be loaded ({e}). Using exact matching only.")
+        if self._embedder is False:
+            return None
+        try:
+            return self._embedder.encode(messages[-1]['content'], normalize_embeddings=True)
+        except Exception as e:
+            self._embedder=False
+            self.log_display.write(f"[MODEL:WARN] Embedding the prompt failed ({e}); semantic_cache disabled. Using exact matching only.")
+            return None
+
+    def _semantic_lookup(self, model_name, embedding) -> str | None:
+        """Returns the cached response whose prompt is most similar to embedding, if it clears the threshold."""
+        entries=self._semantic_index.get(model_name)
+        if not entries:
+            return None
+        import numpy as np
+
+        # Embeddings are unit length, so the dot product is the cosine similarity
+        scores=np.stack([vector for vector, _ in entries]) @ embedding
+        best=int(scores.argmax())
+        if scores[best] > _SEMANTIC_CACHE_THRESHOLD:
+            return entries[best][1]
+        return None
+
+    def _semantic_store(self, model_name, embedding, response_text: str):
+        entries=self._semantic_index.setdefault(model_name, [])
+        entries.append((embedding, response_text))
+        if len(entries) > _SEMANTIC_CACHE_SIZE:
+            del entries[0]
+
+    def call_model(self, model_name, messages, mode='chat', cacheable: bool | None=None):
+        """
+        Main dispatcher for API calls.
+        Identical requests are answered from an in-memory cache for up to _RESPONSE_CACHE_TTL seconds.
+        Only chat mode is cached by default; agent turns drive tools with side effects (and run at a higher
+        temperature), so they always reach the model unless cacheable=True. Requests at any temperature
+        other than _CACHEABLE_TEMPERATURE are never cached.
+        """
         provider=self.config.get_provider(model_name)
                 
         if not provider:
@@ -150,12 +346,61 @@ class ModelManager:
             )
             return f"ERROR: {error_msg}"
 
+        # CRITICAL: Agent mode gets the higher temperature
+        temperature=0.7 if mode == 'agent' else 0.3
+
+        if cacheable is None:
+            cacheable=mode == 'chat'
+
+        cache_key=None
+        if cacheable and temperature == _CACHEABLE_TEMPERATURE:
+            cache_key=hashlib.blake2b(json_dumps([model_name, messages, temperature])).hexdigest()
+            cached=self._exact_cache.get(cache_key)
+            if cached is not None:
+                stored_at, cached_text=cached
+                if time.monotonic() - stored_at < _RESPONSE_CACHE_TTL:
+                    self._exact_cache.move_to_end(cache_key)
+                    self.log_display.write(f"[MODEL:INFO] Using cached response from {model_name}.")
+                    return cached_text
+                self._exact_cache.pop(cache_key, None) # expired
+
+        # Paraphrased chat prompts can still hit the (opt-in) semantic cache
+        embedding=None
+        if cache_key is not None and mode == 'chat' and self.config.config.get('semantic_cache'):
+            embedding=self._embed_prompt(messages)
+            if embedding is not None:
+                similar=self._semantic_lookup(model_name, embedding)
+                if similar is not None:
+                    self.log_display.write(f"[MODEL:INFO] Using cached response from {model_name} for a similar prompt.")
+                    return similar
+
         self.log_display.write(f"[MODEL:INFO] Calling {provider['name']} with model {model_name}...")
 
         if provider['type'] == 'ollama':
-            return self.call_ollama(model_name, messages, provider)
+            cancel_event=threading.Event()
+            self._cancel_events.add(cancel_event)
+            try:
+                response_text=self.call_ollama(model_name, messages, provider, temperature=temperature, cancel_event=cancel_event)
+            finally:
+                self._cancel_events.discard(cancel_event)
         elif provider['type'] == 'external':
             # Note: External logic still needs full implementation for production use
-            return self.call_external(model_name, messages, provider)
-                    
-        return f"ERROR: Unknown provider type '{provider['type']}'"
+            response_text=self.call_external(model_name, messages, provider)
+        else:
+            return f"ERROR: Unknown provider type '{provider['type']}'"
+
+        if cache_key is not None and not response_text.startswith("ERROR"):
+            self._exact_cache[cache_key]=(time.monotonic(), response_text)
+            if len(self._exact_cache) > _RESPONSE_CACHE_SIZE:
+                self._exact_cache.popitem(last=False)
+            if embedding is not None:
+                self._semantic_store(model_name, embedding, response_text)
+
+        return response_text
+
+    async def acall_model(self, model_name, messages, mode='chat', cacheable: bool | None=None):
+        """
+        Awaitable call_model for the app's event loop. The blocking request runs in a worker thread,
+        so the UI stays responsive and several calls can be awaited concurrently (e.g. with asyncio.gather).
+        """
+        return await asyncio.to_thread(self.call_model, model_name, messages, mode=mode, cacheable=cacheable)
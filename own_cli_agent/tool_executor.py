@@ -1,37 +1,262 @@
 # tool_executor.py
 
+import functools
+import os
+import selectors
+import shlex
+import shutil
+import signal
 import subprocess
+import threading
+import time
+import uuid
 from pathlib import Path
 from .config import TEMP_PROJECT_DIR # Relative import
 
+# Seconds a single run_code command may take
+_COMMAND_TIMEOUT=300
+
+# A command containing any of these needs a shell to interpret it
+_SHELL_CHARS=frozenset(";|&<>`$*?~(){}[]!#\n\\")
+
+# run_code keeps at most this much of each stream (start and end); the middle is elided so chatty
+# commands don't flood the TUI, the agent's context or memory
+_OUTPUT_HEAD=8192
+_OUTPUT_TAIL=2048
+
+
+def _elision(count: int) -> str:
+    return f"\n...[{count} bytes elided]...\n"
+
+
+def _cap(text: str, head: int=_OUTPUT_HEAD, tail: int=_OUTPUT_TAIL) -> str:
+    """Keeps the first head and last tail characters of text, marking how much was dropped in between."""
+    if len(text) <= head + tail:
+        return text
+    return text[:head] + _elision(len(text) - head - tail) + text[-tail:]
+
+
+class _CappedStream:
+    """
+    Collects one output pipe of the bash session while it is being read, holding only the first
+    _OUTPUT_HEAD bytes and a sliding window at the end (large enough for the sentinel line).
+    """
+    # Extra room in the tail window for the sentinel line that ends every command
+    _TAIL_WINDOW=_OUTPUT_TAIL + 256
+
+    def __init__(self, marker: bytes):
+        self._marker=marker
+        self._buffer=bytearray()
+        self._dropped=0
+        self.marker_at=-1
+
+    def feed(self, chunk: bytes) -> bool:
+        """Adds chunk; returns True once the full sentinel line has arrived."""
+        self._buffer+=chunk
+        excess=len(self._buffer) - _OUTPUT_HEAD - self._TAIL_WINDOW
+        if excess > 0 and self.marker_at != -1:
+            # Once the marker is found only output before it may go, and marker_at moves with the cut
+            excess=min(excess, self.marker_at - _OUTPUT_HEAD)
+        if excess > 0:
+            del self._buffer[_OUTPUT_HEAD:_OUTPUT_HEAD + excess]
+            self._dropped+=excess
+            if self.marker_at != -1:
+                self.marker_at-=excess
+        # Only the newly arrived bytes (plus a marker's length before them) can complete the marker
+        start=max(_OUTPUT_HEAD if self._dropped else 0, len(self._buffer) - len(chunk) - len(self._marker))
+        if self.marker_at == -1:
+            self.marker_at=self._buffer.find(self._marker, start)
+        return self.marker_at != -1 and self._buffer.find(b"\n", self.marker_at + len(self._marker)) != -1
+
+    def after_marker(self) -> bytes:
+        return bytes(self._buffer[self.marker_at + len(self._marker):])
+
+    def text(self) -> str:
+        """The captured output (without the sentinel), decoded and with any elided middle marked."""
+        end=self.marker_at if self.marker_at != -1 else len(self._buffer)
+        head=self._buffer[:min(end, _OUTPUT_HEAD)]
+        rest=self._buffer[len(head):end]
+        dropped=self._dropped
+        if len(rest) > _OUTPUT_TAIL:
+            dropped+=len(rest) - _OUTPUT_TAIL
+            rest=rest[-_OUTPUT_TAIL:]
+        if not dropped:
+            return (head + rest).decode('utf-8', errors='replace')
+        return head.decode('utf-8', errors='replace') + _elision(dropped) + rest.decode('utf-8', errors='replace')
+
+
+
+@functools.lru_cache(maxsize=256)
+def _ensure_dir(directory: Path):
+    """mkdir -p, remembered so files landing in the same folder skip the repeated stat/mkdir calls."""
+    directory.mkdir(parents=True, exist_ok=True)
+
+
+def _write_bytes(path: Path, data: bytes):
+    """Writes data to path with a single low-level descriptor (no Python file object or text layer)."""
+    fd=os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view=memoryview(data)
+        while view:
+            view=view[os.write(fd, view):] # os.write may write only part of the buffer
+    finally:
+        os.close(fd)
+
+
+class _BashSession:
+    """
+    A long-lived bash process in the project folder that run_code sends commands to, so each call
+    skips the fork/exec and shell start-up of subprocess.run, and cd/export carry over between calls.
+
+    Each command is passed through a quoted heredoc (no re-parsing by the outer shell) and eval'd with
+    stdin from /dev/null; a random sentinel line printed afterwards on stdout (with the exit code) and
+    on stderr marks where its output ends.
+    """
+
+    def __init__(self, cwd: Path):
+        self._cwd=cwd
+        self._proc: subprocess.Popen | None=None
+        self._lock=threading.Lock()
+
+    def _spawn(self):
+        self._proc=subprocess.Popen(
+            ["bash", "--norc", "--noprofile"],
+            cwd=self._cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True # Own process group, so a timeout can kill the command's children too
+        )
+
+    def close(self):
+        """Kills the shell (and anything it started); the next run() spawns a fresh one."""
+        if self._proc is not None:
+            try:
+                os.killpg(self._proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            self._proc.wait()
+            for stream in (self._proc.stdin, self._proc.stdout, self._proc.stderr):
+                stream.close()
+            self._proc=None
+
+    def run(self, command: str, timeout: float) -> tuple[int, str, str]:
+        """
+        Runs command and returns (returncode, stdout, stderr), each stream capped (see _CappedStream).
+        Raises subprocess.TimeoutExpired (after killing the shell) if it does not finish within timeout.
+        """
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self.close()
+                self._spawn()
+            proc=self._proc
+
+            token=f"__OWN_CLI_{uuid.uuid4().hex}__"
+            script=(
+                f"IFS= read -r -d '' __own_cli_cmd <<'{token}'\n{command}\n{token}\n"
+                f"eval \"$__own_cli_cmd\" </dev/null; __own_cli_rc=$?\n"
+                f"printf '\\n%s %d\\n' '{token}' \"$__own_cli_rc\"; printf '\\n%s\\n' '{token}' >&2\n"
+            )
+            marker=b"\n" + token.encode()
+            try:
+                proc.stdin.write(script.encode('utf-8'))
+                proc.stdin.flush()
+            except BrokenPipeError:
+                self.close()
+                raise RuntimeError("bash session exited unexpectedly")
+
+            streams={proc.stdout.fileno(): _CappedStream(marker), proc.stderr.fileno(): _CappedStream(marker)}
+            done=set()
+            deadline=time.monotonic() + timeout
+            with selectors.DefaultSelector() as selector:
+                for fd in streams:
+                    selector.register(fd, selectors.EVENT_READ)
+                while len(done) < len(streams):
+                    remaining=deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.close()
+                        raise subprocess.TimeoutExpired(command, timeout)
+                    for key, _ in selector.select(remaining):
+                        chunk=os.read(key.fd, 65536)
+                        if not chunk:
+                            # The command ended the shell itself (e.g. exit); report what it printed
+                            selector.unregister(key.fd)
+                            done.add(key.fd)
+                            continue
+                        # Finished once the whole sentinel line (with the exit code on stdout) has arrived
+                        if streams[key.fd].feed(chunk):
+                            selector.unregister(key.fd)
+                            done.add(key.fd)
+
+            stdout=streams[proc.stdout.fileno()]
+            stderr=streams[proc.stderr.fileno()]
+            if stdout.marker_at == -1:
+                returncode=proc.wait()
+                self.close()
+            else:
+                returncode=int(stdout.after_marker().split()[0])
+            return returncode, stdout.text(), stderr.text()
+
+
 class ToolExecutor:
     """Executes tools requested by the model (like running code or writing files)."""
     def __init__(self, permissions_manager, log_display, app_instance):
         self.permissions=permissions_manager
         self.log_display=log_display  
         self.app=app_instance # Reference to the main App for logging
+        # Resolved once; write_file targets must resolve to somewhere inside it
+        self._root=TEMP_PROJECT_DIR.resolve()
+        # Persistent shell for run_code; None where bash is unavailable (falls back to subprocess.run)
+        self._bash=_BashSession(TEMP_PROJECT_DIR) if shutil.which("bash") else None
+
+    def close(self):
+        """Stops the persistent shell (called when the app shuts down)."""
+        if self._bash is not None:
+            self._bash.close()
+
+    def _run_oneshot(self, command: str) -> tuple[int, str, str]:
+        """
+        Runs command in a fresh process; used when no persistent bash session is available.
+        Plain commands are exec'd directly from their shlex-split argv, skipping the extra /bin/sh;
+        anything with shell syntax still goes through the shell.
+        """
+        needs_shell=not _SHELL_CHARS.isdisjoint(command)
+        run_options=dict(cwd=TEMP_PROJECT_DIR, capture_output=True, text=True, timeout=_COMMAND_TIMEOUT)
+        try:
+            result=subprocess.run(command if needs_shell else shlex.split(command), shell=needs_shell, **run_options)
+        except (FileNotFoundError, ValueError):
+            if needs_shell:
+                raise
+            # Not an executable (e.g. a shell builtin like cd) or unbalanced quotes: let the shell handle it
+            result=subprocess.run(command, shell=True, **run_options)
+        return result.returncode, _cap(result.stdout), _cap(result.stderr)
                 
     def write_file(self, path: str, content: str) -> str:
         """Writes content to a file in the project directory."""
         if not self.permissions.is_allowed('allow_file_io'):
             return "TOOL:ERROR: File I/O is blocked by permissions. Change permissions.json to enable."
 
-        # Security check: Ensure path does not try to escape the project folder
-        if '..' in path or path.startswith('/'):
-            return "TOOL:ERROR: Invalid path. Path must be relative and inside the project folder."
-                
         full_path=TEMP_PROJECT_DIR / path
-                
-        full_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Security check: Ensure path does not try to escape the project folder.
+        # Resolving catches absolute paths, '..' segments and symlinks pointing outside in one step.
+        if not full_path.resolve().is_relative_to(self._root):
+            return "TOOL:ERROR: Invalid path. Path must be relative and inside the project folder."
+        data=content.encode('utf-8') if isinstance(content, str) else content
                 
         try:
-            with open(full_path, 'w') as f:
-                f.write(content)
+            _ensure_dir(full_path.parent)
+            try:
+                _write_bytes(full_path, data)
+            except FileNotFoundError:
+                # The folder was removed since it was cached (e.g. by run_code); create it again
+                _ensure_dir.cache_clear()
+                _ensure_dir(full_path.parent)
+                _write_bytes(full_path, data)
             self.log_display.write(f"[TOOL:INFO] File written successfully: {full_path.relative_to(Path.cwd())}")
             return f"TOOL:SUCCESS: File written: {path}"
         except Exception as e:
-            self.app._log_error_to_file(f"Tool Error: Failed to write file {path}", e)
-            self.log_display.write(f"[TOOL:ERROR] Failed to write file {path}: {e}")
+            self.app._log_error_to_file(f"Tool Error: Failed to write file {path}", e, f"[TOOL:ERROR] Failed to write file {path}: {e}")
             return f"TOOL:ERROR: Failed to write file {path}: {e}"
 
     def run_code(self, command: str) -> str:
@@ -42,27 +267,22 @@ class ToolExecutor:
         self.log_display.write(f"[TOOL:EXEC] Running command: '{command}' in {TEMP_PROJECT_DIR.relative_to(Path.home())}")
 
         try:
-            result=subprocess.run(
-                command,
-                cwd=TEMP_PROJECT_DIR,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=300
-            )
-                        
-            output=result.stdout
-            error=result.stderr
+            if self._bash is not None:
+                returncode, output, error=self._bash.run(command, _COMMAND_TIMEOUT)
+            else:
+                returncode, output, error=self._run_oneshot(command)
                         
             # Format output/error clearly for the agent
-            if result.returncode == 0:
+            if returncode == 0:
                 # --- START FIX: Return raw output to agent ---
                 
-                # 1. Log to TUI for human viewing
-                self.log_display.write(f"[TOOL:SUCCESS] Command executed (Code 0).")
-                self.log_display.write(f"--- STDOUT ---")
-                self.log_display.write(output.strip()) # Print cleaned output to TUI
-                self.log_display.write(f"--------------")
+                # 1. Log to TUI for human viewing (one write for the whole block)
+                self.log_display.write("\n".join((
+                    "[TOOL:SUCCESS] Command executed (Code 0).",
+                    "--- STDOUT ---",
+                    output.strip(), # Print cleaned output to TUI
+                    "--------------"
+                )))
                 
                 # 2. Return to AGENT: Return the RAW output, only prefixed by the SUCCESS tag.
                 # .strip() removes the trailing newline (\n) from the print statement, ensuring clean parsing.
@@ -72,16 +292,17 @@ class ToolExecutor:
             else:
                 stderr_formatted=f"Stderr (Truncated):\n{error[:500]}..." if len(error) > 500 else f"Stderr:\n{error}"
                 # CRITICAL: Log detailed command error to file
-                self.app._log_error_to_file(f"Tool Error: Command failed (Code {result.returncode})", None)
-                self.log_display.write(f"[TOOL:ERROR] Command failed (Code {result.returncode}). {stderr_formatted.splitlines()[0]}...")
+                self.app._log_error_to_file(
+                    f"Tool Error: Command failed (Code {returncode})",
+                    None,
+                    f"[TOOL:ERROR] Command failed (Code {returncode}). {stderr_formatted.splitlines()[0]}..."
+                )
                 
-                return f"TOOL:ERROR: Command failed (Code {result.returncode}).\n{stderr_formatted}\nOutput:\n{output.strip()}"
+                return f"TOOL:ERROR: Command failed (Code {returncode}).\n{stderr_formatted}\nOutput:\n{output.strip()}"
 
         except subprocess.TimeoutExpired:
-            self.app._log_error_to_file("Tool Error: Command timed out", None)
-            self.log_display.write("[TOOL:ERROR] Command timed out after 300 seconds.")
-            return "TOOL:ERROR: Command timed out after 30 seconds."
+            self.app._log_error_to_file("Tool Error: Command timed out", None, f"[TOOL:ERROR] Command timed out after {_COMMAND_TIMEOUT} seconds.")
+            return f"TOOL:ERROR: Command timed out after {_COMMAND_TIMEOUT} seconds."
         except Exception as e:
-            self.app._log_error_to_file("Tool Error: Execution failed", e)
-            self.log_display.write(f"[TOOL:ERROR] Execution failed: {e}")
+            self.app._log_error_to_file("Tool Error: Execution failed", e, f"[TOOL:ERROR] Execution failed: {e}")
             return f"TOOL:ERROR: Execution failed: {e}"
@@ -23,6 +23,10 @@ fi
 # Install required pip things!
 pip install textual requests
 pip install pyperclip pynput elevenlabs pyttsx3 pygame
+# Optional: faster JSON parsing/serialization (falls back to the stdlib json module)
+pip install orjson
+# Optional: semantic response cache for chat mode (set "semantic_cache": true in config.json)
+# pip install sentence-transformers
 
 
 echo "Looking For Ollama..."
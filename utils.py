@@ -1,13 +1,122 @@
 #
 # (c) J~Net 2025
 #
+import hashlib
+import io
 import os
-from elevenlabs import Voice, VoiceSettings, play
-from elevenlabs.client import ElevenLabs
-import pyttsx3
+import random
+import sys
+from pathlib import Path
 import re
-import requests
-import pygame
+# NOTE: elevenlabs, pyttsx3, pygame and emoji are imported inside the functions that use them,
+# so importing utils (and every run that never speaks) doesn't pay for the audio stacks.
+
+# ElevenLabs voice used by speak_response (also part of the TTS cache key)
+TTS_VOICE_ID='21m00Tcm4TlvDq8ikWAM'
+TTS_STABILITY=0.5
+TTS_SIMILARITY_BOOST=0.7
+
+# Generated speech is cached on disk so repeated phrases skip the API call
+TTS_CACHE_DIR=Path.home() / ".cache" / "own_cli_agent" / "tts"
+TTS_CACHE_MAX_BYTES=200 * 1024 * 1024 # Oldest clips (by mtime) are evicted above this
+
+# pyttsx3 fallback engine, created and configured once by _get_pyttsx3_engine
+_tts_engine=None
+_tts_voice_id=None
+
+# SSML-style markup added to the fallback speech: a pause after sentence punctuation and a
+# random prosody rate around each word, matched together so the text is scanned only once
+_SPEECH_MARKUP_RE=re.compile(r'([.!?])|\b(\w+)\b')
+_FILLERS=("um", "uh", "like", "you know")
+_FILLER_CHANCE=0.05 # Chance of a filler before each word (after the first)
+
+# sanitize_for_speech: keep letters, digits, whitespace and basic punctuation; drop markdown '*'
+_UNSPEAKABLE_RE=re.compile(r'[^A-Za-z0-9\s.,!?\'"]+')
+_STRIP_STARS=str.maketrans('', '', '*')
+
+
+def _add_fillers(text):
+    """Adds natural-sounding filler words between words in a single pass."""
+    words=text.split()
+    out=[]
+    for i, word in enumerate(words):
+        if i and random.random() < _FILLER_CHANCE:
+            out.append(random.choice(_FILLERS))
+        out.append(word)
+    return ' '.join(out)
+
+def _speech_markup(match):
+    punctuation=match.group(1)
+    if punctuation:
+        return f'{punctuation}<break time="500ms"/>'
+    return f'<prosody rate="{random.randint(90, 110)}%">{match.group(2)}</prosody>'
+
+
+def _get_pyttsx3_engine():
+    """Returns the shared pyttsx3 engine, initializing it and picking a voice on first use."""
+    global _tts_engine, _tts_voice_id
+    if _tts_engine is None:
+        import pyttsx3
+
+        engine=pyttsx3.init()
+        voices=engine.getProperty('voices')
+        
+        # Try to find an American or Indian female English voice
+        target_voice=next((voice for voice in voices if ('en-us' in voice.id.lower() or 'en-in' in voice.id.lower()) and voice.gender == 'female'), None)
+        if target_voice is None:
+            # If no specific female voice found, try to find any female voice
+            target_voice=next((voice for voice in voices if voice.gender == 'female'), None)
+        
+        if target_voice:
+            _tts_voice_id=target_voice.id
+            engine.setProperty('voice', _tts_voice_id)
+        # else: Female voice not found. Using default.
+        
+        engine.setProperty('rate', 165)  # Slightly slower for a more natural female voice
+        engine.setProperty('pitch', 1.1)  # Slightly higher pitch for female voice
+        engine.setProperty('volume', 0.85)
+        _tts_engine=engine
+    return _tts_engine
+
+def _tts_cache_path(text):
+    key=hashlib.sha256(f"{TTS_VOICE_ID}|{TTS_STABILITY}|{TTS_SIMILARITY_BOOST}|{text}".encode('utf-8')).hexdigest()
+    return TTS_CACHE_DIR / f"{key}.mp3"
+
+def _store_tts_audio(path, audio):
+    """Writes the generated MP3 to the cache atomically, then trims the cache to TTS_CACHE_MAX_BYTES."""
+    TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path=path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(audio)
+    os.replace(tmp_path, path)
+
+    clips=[(entry.stat().st_mtime, entry.stat().st_size, entry) for entry in TTS_CACHE_DIR.glob("*.mp3")]
+    total=sum(size for _, size, _ in clips)
+    if total > TTS_CACHE_MAX_BYTES:
+        for _, size, entry in sorted(clips, key=lambda clip: clip[0]):
+            if total <= TTS_CACHE_MAX_BYTES:
+                break
+            entry.unlink(missing_ok=True)
+            total-=size
+
+_mixer_ready=False
+
+def _ensure_mixer():
+    """Initializes pygame.mixer on first use and returns the pygame module."""
+    global _mixer_ready
+    import pygame
+
+    if not _mixer_ready:
+        pygame.mixer.init(frequency=44100, channels=2, buffer=1024)
+        _mixer_ready=True
+    return pygame
+
+def _play_mp3(audio):
+    """Plays MP3 bytes straight from memory and blocks until they finish."""
+    pygame=_ensure_mixer()
+    channel=pygame.mixer.Sound(file=io.BytesIO(audio)).play()
+    while channel is not None and channel.get_busy():
+        pygame.time.wait(20)
 
 
 def get_or_set_elevendlabs_api_key():
@@ -22,58 +131,45 @@ def get_or_set_elevendlabs_api_key():
 
 def speak_response(text):
     ELEVENLABS_API_KEY=get_or_set_elevendlabs_api_key()
-    client=ElevenLabs(api_key=ELEVENLABS_API_KEY)
 
     try:
-        voice=Voice(
-            voice_id='21m00Tcm4TlvDq8ikWAM',
-            settings=VoiceSettings(stability=0.5, similarity_boost=0.7, style=0.0, use_speaker_boost=True)
-        )
-        
         # Start the animation only if it has been initialized
         if animation.initialized:
             start_animation()
-        
-        # Generate and play audio
-        audio=client.generate(text=text, voice=voice)
-        play(audio)
+
+        # Replay a cached clip when this exact text was spoken before
+        cache_path=_tts_cache_path(text)
+        try:
+            audio=cache_path.read_bytes()
+            os.utime(cache_path) # Mark as recently used for eviction
+        except FileNotFoundError:
+            # Imported here so a missing/broken elevenlabs install also falls back to pyttsx3
+            from elevenlabs import Voice, VoiceSettings
+            from elevenlabs.client import ElevenLabs
+
+            client=ElevenLabs(api_key=ELEVENLABS_API_KEY)
+            voice=Voice(
+                voice_id=TTS_VOICE_ID,
+                settings=VoiceSettings(stability=TTS_STABILITY, similarity_boost=TTS_SIMILARITY_BOOST, style=0.0, use_speaker_boost=True)
+            )
+            
+            # Generate and cache audio
+            audio=client.generate(text=text, voice=voice)
+            if not isinstance(audio, bytes):
+                audio=b"".join(audio) # generate() may return the MP3 as a stream of chunks
+            _store_tts_audio(cache_path, audio)
+
+        _play_mp3(audio)
         
     except Exception as e:
         # print(f"Error with ElevenLabs API: {e}")
         # print("Falling back to pyttsx3...")
-        engine=pyttsx3.init()
-        voices=engine.getProperty('voices')
-        
-        # Try to find an American or Indian female English voice
-        target_voice=next((voice for voice in voices if ('en-us' in voice.id.lower() or 'en-in' in voice.id.lower()) and voice.gender == 'female'), None)
-        
-        if target_voice:
-            engine.setProperty('voice', target_voice.id)
-        else:
-            # If no specific female voice found, try to find any female voice
-            female_voice=next((voice for voice in voices if voice.gender == 'female'), None)
-            if female_voice:
-                engine.setProperty('voice', female_voice.id)
-            # else:
-                # print("Female voice not found. Using default.")
-        
-        engine.setProperty('rate', 165)  # Slightly slower for a more natural female voice
-        engine.setProperty('pitch', 1.1)  # Slightly higher pitch for female voice
-        engine.setProperty('volume', 0.85)
+        engine=_get_pyttsx3_engine()
         # Add more natural speech patterns
-        def add_fillers(text):
-            fillers=["um", "uh", "like", "you know"]
-            words=text.split()
-            for i in range(len(words) - 1, 0, -1):
-                if random.random() < 0.05:  # 5% chance to add a filler
-                    words.insert(i, random.choice(fillers))
-            return ' '.join(words)
-        
-        text_with_fillers=add_fillers(text)
+        text_with_fillers=_add_fillers(text)
         
-        # Add pauses and emphasis
-        text_with_pauses=re.sub(r'([.!?])', r'\1<break time="500ms"/>', text_with_fillers)
-        text_with_emphasis=re.sub(r'\b(\w+)\b', lambda m: f'<prosody rate="{random.randint(90, 110)}%">{m.group(1)}</prosody>', text_with_pauses)
+        # Add pauses and emphasis in one pass (the inserted <break> tags are no longer re-scanned as words)
+        text_with_emphasis=_SPEECH_MARKUP_RE.sub(_speech_markup, text_with_fillers)
         
         engine.say(text_with_emphasis)
         engine.runAndWait()
@@ -89,21 +185,26 @@ def speak_response(text):
         
 def shorten_response(text, max_length=500):
     if len(text) > max_length:
-        sentences=text.split('. ')
-        truncated_text=''
-        for sentence in sentences:
-            if len(truncated_text) + len(sentence) + 1 <= max_length:
-                truncated_text += sentence + '. '
-            else:
+        # Collect whole sentences with a running length instead of growing a string
+        parts=[]
+        total=0 # Length of the text so far, counting the '. ' after each sentence
+        for sentence in text.split('. '):
+            if total + len(sentence) + 1 > max_length:
                 break
-        truncated_text=truncated_text.strip()
+            parts.append(sentence)
+            total+=len(sentence) + 2
+        truncated_text=('. '.join(parts) + '.').strip() if parts else ''
         return truncated_text if truncated_text.endswith('.') else truncated_text + '...'
     return text
 
 def sanitize_for_speech(text):
-    sanitized_text=text.replace('*', '')
-    sanitized_text=emoji.replace_emoji(sanitized_text, replace='')
-    sanitized_text=re.sub(r'[^A-Za-z0-9\s.,!?\'"]+', '', sanitized_text)
+    sanitized_text=text.translate(_STRIP_STARS)
+    # Emoji are never ASCII, so plain-ASCII text skips the emoji import and table scan
+    if not sanitized_text.isascii():
+        import emoji
+
+        sanitized_text=emoji.replace_emoji(sanitized_text, replace='')
+    sanitized_text=_UNSPEAKABLE_RE.sub('', sanitized_text)
     return sanitized_text    
     
 def google_search(query):
@@ -114,9 +215,13 @@ def google_search(query):
 
 def cleanup():
     print("\nCleaning up...")
+    global _mixer_ready
     try:
-        if pygame.mixer.get_init():
+        # Nothing to shut down if audio was never played (pygame never imported)
+        pygame=sys.modules.get('pygame')
+        if pygame is not None and pygame.mixer.get_init():
             pygame.mixer.quit()
+        _mixer_ready=False
     except Exception as e:
         print(f"Error during cleanup: {e}")
     